@@ -1,17 +1,25 @@
-from PIL import Image, ImageDraw
+from PIL import Image, ImageColor
+import contextlib
 import click
-import imageio
 import numpy as np
 import random
 import math
+import os
 
 from src.midi_stuff import (
     get_frames_where_notes_happen,
     SOUND_FONT_FILE_BETTER,
 )
-from src.video_stuff import finalize_video_with_music
+from src.video_stuff import (
+    finalize_video_with_music,
+    get_frame_buffer,
+    get_video_writer,
+    ParallelFrameWriter,
+    start_music,
+)
 from src.cache_stuff import get_cache_dir, cleanup_cache_dir
-from src.animation_stuff import lerp
+from src.draw_stuff import draw_ellipse, draw_rectangle, get_ink, RectangleLayer
+from src.physics_stuff import hide_boxes_touching, PlatformGrid
 
 # Define main colors for the game elements
 BG_COLOR = "#b1afaf"
@@ -54,8 +62,16 @@ END_VIDEO_FREEZE_SECONDS = 3
 
 BUMP_DIST = math.floor(BALL_SPEED * 1.5)
 
+# Smoothing factor for the camera following the ball
+CAMERA_ALPHA = BALL_SPEED / 150
+
+# Platforms and the ball fit in a cell, so each one only touches up to 4 cells
+PLATFORM_GRID_CELL = 2 * max(PLATFORM_HEIGHT, BALL_SIZE)
+
 STRATEGY_RANDOM = "random"
 STRATEGY_ALTERNATE = "alternate"
+# Try the platform orientation that is furthest from the other platforms first
+STRATEGY_SPREAD = "spread"
 
 
 class BadSimulation(Exception):
@@ -103,10 +119,9 @@ class Thing:
     def bump_down(self, bump_dist=BUMP_DIST):
         self._y_bump = bump_pattern(bump_dist)
 
-    def render(self, image, offset_x, offset_y):
+    def render(self, draw, offset_x, offset_y):
         if not self.visible:
             return
-        draw = ImageDraw.Draw(image)
         # Calculate the adjusted coordinates with bump included
 
         x_bump = 0
@@ -173,10 +188,9 @@ class Particle:
             if self.size < 1:
                 self.size = 0  # Ensure size doesn't go negative
 
-    def render(self, image, offset_x, offset_y):
+    def render(self, draw, offset_x, offset_y):
         """Render the particle if it's still alive and has a size greater than zero."""
         if self.lifespan > 0 and self.size > 0:
-            draw = ImageDraw.Draw(image)
             radius = self.size
             draw.ellipse(
                 [
@@ -241,10 +255,10 @@ class Platform(Thing):
             if particle.lifespan <= 0:
                 self.particles.remove(particle)
 
-    def render(self, image, offset_x, offset_y):
+    def render(self, draw, offset_x, offset_y):
         for particle in self.particles:
-            particle.render(image, offset_x, offset_y)
-        super().render(image, offset_x, offset_y)
+            particle.render(draw, offset_x, offset_y)
+        super().render(draw, offset_x, offset_y)
 
     def set_expected_bounce_frame(self, frame):
         if self._expected_bounce_frame:
@@ -254,6 +268,9 @@ class Platform(Thing):
     def expected_bounce_frame(self):
         return self._expected_bounce_frame
 
+    def reset_expected_bounce_frame(self, frame):
+        self._expected_bounce_frame = frame
+
 
 class Ball(Thing):
     def __init__(self, x_coord, y_coord, size, color, speed, show_carve=False, fill_color=None):
@@ -262,6 +279,9 @@ class Ball(Thing):
         self.y_speed = speed
         self.original_color = color
         self.size = size
+        # Parse the hex colors once, instead of on every draw call
+        self._rgb = ImageColor.getrgb(color)
+        self._fill_rgb = ImageColor.getrgb(fill_color) if fill_color else None
 
         self._carve_top_left_corner = None
         self._carve_top_right_corner = None
@@ -298,9 +318,8 @@ class Ball(Thing):
             self.fix_box_modifiers(self._box_modifiers[5], fix_speed),
         ]
 
-    def render(self, image, offset_x, offset_y):
+    def render(self, draw, offset_x, offset_y):
         ld, rd, td, bd, xd, yd = self._box_modifiers
-        draw = ImageDraw.Draw(image)
         left = self.x_coord - offset_x + xd
         right = self.x_coord - offset_x + self.size + xd
         top = self.y_coord - offset_y + yd
@@ -333,19 +352,27 @@ class Ball(Thing):
             draw.rectangle([(min_x, min_y), (max_x, max_y)], outline="red", width=1)
 
     def get_color(self):
-        return self.original_color
+        return self._rgb
+
+    def get_fill_color(self):
+        return self._fill_rgb
+
+    def get_state(self):
+        return self.x_coord, self.y_coord, self.x_speed, self.y_speed
+
+    def set_state(self, state):
+        self.x_coord, self.y_coord, self.x_speed, self.y_speed = state
 
     def predict_position(self, frames=1):
         future_x = self.x_coord + self.x_speed * frames
         future_y = self.y_coord + self.y_speed * frames
         return future_x, future_y
 
-    def move(self, platforms, walls, frame, visible_bounds, bump_paddles=False):
+    def move(self, platforms, frame, visible_bounds, bump_paddles=False):
         # Calculate potential next position of the ball
         next_x = self.x_coord
         next_y = self.y_coord
         hit_platform = None
-        is_carving = len(walls) > 0
 
         # Check each platform for a possible collision
         for platform in platforms:
@@ -364,13 +391,11 @@ class Ball(Thing):
             plat_bottom = platform.y_coord + platform.height
 
             # Check if the ball's next position overlaps with the platform
-            if all(
-                [
-                    ball_right >= plat_left,
-                    ball_left <= plat_right,
-                    ball_bottom >= plat_top,
-                    ball_top <= plat_bottom,
-                ]
+            if (
+                ball_right >= plat_left
+                and ball_left <= plat_right
+                and ball_bottom >= plat_top
+                and ball_top <= plat_bottom
             ):
                 # Calculate the overlap on each side
                 overlap_left = ball_right - plat_left
@@ -378,12 +403,19 @@ class Ball(Thing):
                 overlap_top = ball_bottom - plat_top
                 overlap_bottom = plat_bottom - ball_top
 
-                # Determine the smallest overlap to resolve the collision minimally
-                min_overlap = min(overlap_left, overlap_right, overlap_top, overlap_bottom)
+                # Determine the side with the smallest overlap to resolve the collision minimally,
+                # on a tie the first side in left, right, top, bottom order wins
+                side, min_overlap = "left", overlap_left
+                if overlap_right < min_overlap:
+                    side, min_overlap = "right", overlap_right
+                if overlap_top < min_overlap:
+                    side, min_overlap = "top", overlap_top
+                if overlap_bottom < min_overlap:
+                    side = "bottom"
 
                 # Adjust ball's speed and position based on the minimal overlap side
                 ball_hit_on = ""
-                if min_overlap == overlap_left:
+                if side == "left":
                     # Reverse horizontal speed
                     self.x_speed = -abs(self.x_speed)
                     # Reposition to the left of the platform
@@ -392,7 +424,7 @@ class Ball(Thing):
                         platform.bump_right()
                         ball_hit_on = "right"
                         platform.emit_particles("left")
-                elif min_overlap == overlap_right:
+                elif side == "right":
                     # Maintain horizontal speed
                     self.x_speed = abs(self.x_speed)
                     # Reposition to the right of the platform
@@ -401,7 +433,7 @@ class Ball(Thing):
                         platform.bump_left()
                         ball_hit_on = "left"
                         platform.emit_particles("right")
-                elif min_overlap == overlap_top:
+                elif side == "top":
                     # Reverse vertical speed
                     self.y_speed = -abs(self.y_speed)
                     # Reposition above the platform
@@ -410,7 +442,7 @@ class Ball(Thing):
                         platform.bump_down()
                         ball_hit_on = "bottom"
                         platform.emit_particles("top")
-                elif min_overlap == overlap_bottom:
+                elif side == "bottom":
                     # Maintain vertical speed
                     self.y_speed = abs(self.y_speed)
                     # Reposition below the platform
@@ -429,32 +461,22 @@ class Ball(Thing):
         self.x_coord += self.x_speed
         self.y_coord += self.y_speed
 
-        if is_carving:
-            self._update_carve_square()
+        return hit_platform
 
-        for wall in walls:
-            if not wall.in_frame(visible_bounds):
-                continue
-            # Get the minimum and maximum x and y values from the carving corners
-            buffer = PLATFORM_WIDTH
-            ball_left = min(self._carve_top_left_corner[0], self._carve_bottom_left_corner[0]) + buffer
-            ball_right = max(self._carve_top_right_corner[0], self._carve_bottom_right_corner[0]) - buffer
-            ball_top = min(self._carve_top_left_corner[1], self._carve_top_right_corner[1]) + buffer
-            ball_bottom = max(self._carve_bottom_left_corner[1], self._carve_bottom_right_corner[1]) - buffer
-
-            # Check collision with wall
-            if (
-                ball_right >= wall.x_coord
-                and ball_left <= wall.x_coord + wall.width
-                and ball_bottom >= wall.y_coord
-                and ball_top <= wall.y_coord + wall.height
-            ):
-                wall.hide()
+    def carve(self, walls, wall_indexes, visible_bounds, hit_platform):
+        """Grow the carving square with the ball and hide the walls it touches, then start a new one after a bounce."""
+        self._update_carve_square()
 
-        if is_carving and hit_platform:
-            self._initialize_carve_square()
+        # Get the minimum and maximum x and y values from the carving corners
+        buffer = PLATFORM_WIDTH
+        ball_left = min(self._carve_top_left_corner[0], self._carve_bottom_left_corner[0]) + buffer
+        ball_right = max(self._carve_top_right_corner[0], self._carve_bottom_right_corner[0]) - buffer
+        ball_top = min(self._carve_top_left_corner[1], self._carve_top_right_corner[1]) + buffer
+        ball_bottom = max(self._carve_bottom_left_corner[1], self._carve_bottom_right_corner[1]) - buffer
+        walls.hide_touching(wall_indexes, visible_bounds, (ball_left, ball_top, ball_right, ball_bottom))
 
-        return hit_platform
+        if hit_platform:
+            self._initialize_carve_square()
 
     def _initialize_carve_square(self):
         self._carve_top_left_corner = (self.x_coord, self.y_coord)
@@ -489,6 +511,111 @@ class Ball(Thing):
             self._carve_top_left_corner = (self.x_coord, self.y_coord)
 
 
+class WallCarver:
+    """The walls as arrays, so each frame of carving is a single jitted pass over the walls near the camera."""
+
+    def __init__(self, walls, screen_width, screen_height):
+        self.walls = walls
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self._boxes = np.array(
+            [(wall.x_coord, wall.y_coord, wall.x_coord + wall.width, wall.y_coord + wall.height) for wall in walls],
+            dtype=np.int64,
+        ).reshape(-1, 4)
+        self._visible = np.array([wall.visible for wall in walls], dtype=np.bool_)
+        self._walls_by_camera_cell = {}
+
+    def near_camera(self, offset_x, offset_y):
+        """Indexes of the walls that can be in the visible bounds while the camera stays in its current cell."""
+        cell_x = math.floor(offset_x / self.screen_width)
+        cell_y = math.floor(offset_y / self.screen_height)
+        indexes = self._walls_by_camera_cell.get((cell_x, cell_y))
+        if indexes is None:
+            # Covers the visible bounds for every camera offset within the cell
+            x0, y0, x1, y1 = self._boxes.T
+            indexes = np.flatnonzero(
+                (x1 >= (cell_x - 1) * self.screen_width)
+                & (x0 <= (cell_x + 3) * self.screen_width)
+                & (y1 >= (cell_y - 1) * self.screen_height)
+                & (y0 <= (cell_y + 3) * self.screen_height)
+            )
+            self._walls_by_camera_cell[(cell_x, cell_y)] = indexes
+        return indexes
+
+    def in_view(self, offset_x, offset_y, visible_bounds):
+        """Indexes (in order) of the walls still standing within the visible bounds."""
+        indexes = self.near_camera(offset_x, offset_y)
+        x0, y0, x1, y1 = self._boxes[indexes].T
+        visible_left, visible_right, visible_top, visible_bottom = visible_bounds
+        in_view = (x1 >= visible_left) & (x0 <= visible_right) & (y1 >= visible_top) & (y0 <= visible_bottom)
+        return indexes[self._visible[indexes] & in_view]
+
+    def screen_rectangles(self, indexes, offset_x, offset_y, screen_width, screen_height):
+        """The walls at `indexes` as [x0, y0, x1, y1] on screen, clipped to it the same way Thing.render does."""
+        x0, y0, x1, y1 = self._boxes[indexes].T
+        x0 = np.maximum(x0 - offset_x, 0)
+        y0 = np.maximum(y0 - offset_y, 0)
+        x1 = np.minimum(x1 - offset_x, screen_width)
+        y1 = np.minimum(y1 - offset_y, screen_height)
+        on_screen = (x1 > x0) & (y1 > y0)
+        return np.stack([x0, y0, x1, y1], axis=1)[on_screen].tolist()
+
+    def hide_touching(self, indexes, visible_bounds, box):
+        """Hide the walls (out of `indexes`) that are within the visible bounds and touch the box."""
+        visible_bounds = tuple(float(bound) for bound in visible_bounds)
+        box = tuple(float(edge) for edge in box)
+        for index in hide_boxes_touching(self._boxes, self._visible, indexes, visible_bounds, box):
+            self.walls[index].hide()
+
+
+class FrameRecorder:
+    """
+    Stands in for an ImageDraw while a frame is being built - the draw calls are recorded,
+    so the frame can be rasterized later on, in another process.
+    """
+
+    def __init__(self, mode, size):
+        self.mode = mode
+        self.size = size
+        self.calls = []
+        # Where to paint the static walls layer from, instead of drawing the walls one by one
+        self.background = None
+
+    def rectangle(self, xy, fill=None, outline=None, width=1):
+        self.calls.append(("rectangle", xy, fill, outline, width))
+
+    def ellipse(self, xy, fill=None, outline=None, width=1):
+        self.calls.append(("ellipse", xy, fill, outline, width))
+
+
+DRAW_FUNCTIONS = {
+    "rectangle": draw_rectangle,
+    "ellipse": draw_ellipse,
+}
+
+
+# The carved walls don't change while the video is made, so each process rendering frames draws them only once
+static_walls = None
+
+
+def set_static_walls(layer):
+    global static_walls
+    static_walls = layer
+
+
+def rasterize_frame(frame):
+    """Replay the recorded draw calls straight into a numpy frame."""
+    width, height = frame.size
+    canvas = get_frame_buffer((height, width, len(frame.mode)))
+    if frame.background is not None:
+        static_walls.paint(canvas, *frame.background)
+    else:
+        canvas[:] = get_ink(BG_COLOR, frame.mode)
+    for method, xy, fill, outline, outline_width in frame.calls:
+        DRAW_FUNCTIONS[method](canvas, frame.mode, xy, fill=fill, outline=outline, width=outline_width)
+    return canvas
+
+
 class Scene:
     def __init__(
         self,
@@ -502,6 +629,15 @@ class Scene:
         self.screen_height = screen_height
         self.ball = ball
         self.platforms = []
+
+        # How far the camera keeps the ball from its top left corner, depending on which way the ball is going
+        edge_x = screen_width * 0.5
+        edge_y = screen_height * 0.5
+        self._camera_lead_left = edge_x
+        self._camera_lead_right = screen_width - edge_x
+        self._camera_lead_up = edge_y
+        self._camera_lead_down = screen_height - edge_y
+
         self.bounce_frames = bounce_frames
         self.frame_count = 0
         self.offset_x = 0
@@ -510,15 +646,78 @@ class Scene:
         self._platform_orientations = platform_orientations
         self.walls = []
         self.carved = False
+        self._wall_carver = None
+        self._walls_layer = None
+        self._platform_grid = PlatformGrid(PLATFORM_GRID_CELL)
+        self._platforms_with_particles = []
 
     def set_platforms(self, platforms):
         self._platforms_set = True
         self._platform_expectations = {platform.expected_bounce_frame(): platform for platform in platforms}
         self.platforms = platforms
+        self._platform_grid = PlatformGrid(PLATFORM_GRID_CELL, platforms)
+        self._platforms_with_particles = [platform for platform in platforms if platform.particles]
 
     def set_walls(self, walls, carved=False):
         self.carved = carved
         self.walls = walls
+        self._wall_carver = WallCarver(walls, self.screen_width, self.screen_height) if walls and not carved else None
+        self._walls_layer = None
+
+    def walls_layer(self):
+        """The carved walls as a static layer, they are painted from it instead of drawn every frame."""
+        if not self.carved:
+            return None
+        if self._walls_layer is None:
+            self._walls_layer = RectangleLayer(
+                [
+                    (wall.x_coord, wall.y_coord, wall.x_coord + wall.width, wall.y_coord + wall.height)
+                    for wall in self.walls
+                    if wall.visible
+                ],
+                WALL_COLOR,
+                BG_COLOR,
+            )
+        return self._walls_layer
+
+    def save_state(self):
+        return self.ball.get_state(), self.frame_count, self.offset_x, self.offset_y
+
+    def load_state(self, state):
+        ball_state, self.frame_count, self.offset_x, self.offset_y = state
+        self.ball.set_state(ball_state)
+
+    def truncate_platforms(self, count):
+        del self.platforms[count:]
+        self._platform_grid.truncate(count)
+
+    def platforms_near_ball(self):
+        """The platforms the ball could bounce off this frame, in the same order as self.platforms."""
+        ball = self.ball
+        indexes = self._platform_grid.near(
+            ball.x_coord,
+            ball.y_coord,
+            ball.x_coord + ball.width,
+            ball.y_coord + ball.height,
+        )
+        return [self.platforms[index] for index in indexes]
+
+    def next_platform(self, platform_orientation):
+        """The platform to put where the ball will be next, True for horizontal and False for vertical."""
+        future_x, future_y = self.ball.predict_position(2)
+
+        # Horizontal orientation
+        if platform_orientation:
+            pwidth, pheight = PLATFORM_HEIGHT, PLATFORM_WIDTH
+            new_platform_x = future_x + pwidth // 2 if self.ball.x_speed > 0 else future_x - pwidth // 2
+            new_platform_y = future_y - pheight if self.ball.y_speed < 0 else future_y + pheight * 2
+        # Vertical orientation
+        else:
+            pwidth, pheight = PLATFORM_WIDTH, PLATFORM_HEIGHT
+            new_platform_x = future_x - pwidth if self.ball.x_speed < 0 else future_x + pwidth
+            new_platform_y = future_y + pheight // 2 if self.ball.y_speed < 0 else future_y - pheight // 2
+
+        return Platform(new_platform_x, new_platform_y, pwidth, pheight, PADDLE_COLOR)
 
     def update(self, change_colors=False, bump_paddles=False):
         self.frame_count += 1
@@ -526,22 +725,9 @@ class Scene:
         # When the platforms were not set, we are creating them
         if not self._platforms_set and self.frame_count in self.bounce_frames:
             # A note will play on this frame, so we need to put a Platform where the ball will be next
-            future_x, future_y = self.ball.predict_position(2)
-
-            platform_orientation = self._platform_orientations.get(self.frame_count, False)
-            # Horizontal orientation
-            if platform_orientation:
-                pwidth, pheight = PLATFORM_HEIGHT, PLATFORM_WIDTH
-                new_platform_x = future_x + pwidth // 2 if self.ball.x_speed > 0 else future_x - pwidth // 2
-                new_platform_y = future_y - pheight if self.ball.y_speed < 0 else future_y + pheight * 2
-            # Vertical orientation
-            else:
-                pwidth, pheight = PLATFORM_WIDTH, PLATFORM_HEIGHT
-                new_platform_x = future_x - pwidth if self.ball.x_speed < 0 else future_x + pwidth
-                new_platform_y = future_y + pheight // 2 if self.ball.y_speed < 0 else future_y - pheight // 2
-
-            new_platform = Platform(new_platform_x, new_platform_y, pwidth, pheight, PADDLE_COLOR)
+            new_platform = self.next_platform(self._platform_orientations.get(self.frame_count, False))
             self.platforms.append(new_platform)
+            self._platform_grid.append(new_platform)
 
         visible_bounds = (
             self.offset_x - self.screen_width,
@@ -551,16 +737,25 @@ class Scene:
         )
 
         # Move ball and check for collisions
-        # If the walls are already carved, don't pass them into Move, since we can skip the collision checks
+        # Only the platforms near the ball can be hit, so the rest are skipped before calling Move
         if self.carved:
-            hit_platform = self.ball.move(self.platforms, [], self.frame_count, visible_bounds, bump_paddles)
+            hit_platform = self.ball.move(self.platforms_near_ball(), self.frame_count, visible_bounds, bump_paddles)
         else:
-            hit_platform = self.ball.move(self.platforms, self.walls, self.frame_count, visible_bounds)
+            hit_platform = self.ball.move(self.platforms_near_ball(), self.frame_count, visible_bounds)
+
+        # If the walls are already carved, the ball doesn't need to go through them anymore
+        if self._wall_carver is not None:
+            wall_indexes = self._wall_carver.near_camera(self.offset_x, self.offset_y)
+            self.ball.carve(self._wall_carver, wall_indexes, visible_bounds, hit_platform)
 
         self.adjust_camera()
 
-        for platform in self.platforms:
+        # Particles only get emitted by the platform that was hit, so only the recently hit platforms have any
+        if hit_platform and hit_platform.particles and hit_platform not in self._platforms_with_particles:
+            self._platforms_with_particles.append(hit_platform)
+        for platform in self._platforms_with_particles:
             platform.update_particles()
+        self._platforms_with_particles = [platform for platform in self._platforms_with_particles if platform.particles]
 
         if change_colors and hit_platform:
             hit_platform.color = random.choice(RAND_COLORS)
@@ -574,14 +769,11 @@ class Scene:
             raise BadSimulation(f"A platform was hit on the wrong frame {self.frame_count}")
 
     def render(self) -> Image:
-        image = Image.new(
-            "RGBA",
-            (
-                self.screen_width,
-                self.screen_height,
-            ),
-            BG_COLOR,
-        )
+        set_static_walls(self.walls_layer())
+        return Image.fromarray(rasterize_frame(self.record_frame()))
+
+    def record_frame(self):
+        draw = FrameRecorder("RGB", (self.screen_width, self.screen_height))
 
         # Determine the visible area based on the current offset
         visible_bounds = (
@@ -591,46 +783,50 @@ class Scene:
             self.offset_y + self.screen_height,
         )
 
+        # Once carved, the walls are painted from the static layer, lined up with how they'd be drawn at this offset
+        things = self.platforms
+        if self.carved:
+            draw.background = (math.ceil(self.offset_x), math.ceil(self.offset_y))
+        elif self._wall_carver is not None:
+            # While carving, only the walls still standing in view get drawn. There are thousands of them, and they
+            # never move, bump or change color, so they are drawn straight from the carver's boxes
+            indexes = self._wall_carver.in_view(self.offset_x, self.offset_y, visible_bounds)
+            for xy in self._wall_carver.screen_rectangles(
+                indexes, self.offset_x, self.offset_y, SCREEN_WIDTH, SCREEN_HEIGHT
+            ):
+                draw.rectangle(xy, fill=WALL_COLOR)
+
         # Only render walls and platforms if they are within the visible area
-        for obj in self.walls + self.platforms:
+        for obj in things:
             if obj.in_frame(visible_bounds):
-                obj.render(image, self.offset_x, self.offset_y)
+                obj.render(draw, self.offset_x, self.offset_y)
 
         # Only render the ball if it's within the visible area
         if self.ball.in_frame(visible_bounds):
-            self.ball.render(image, self.offset_x, self.offset_y)
+            self.ball.render(draw, self.offset_x, self.offset_y)
 
-        return image
+        return draw
 
     def adjust_camera(self):
-        edge_x = self.screen_width * 0.5
-        edge_y = self.screen_height * 0.5
-
-        # Desired offsets based on ball's position
-        desired_offset_x = (
-            self.ball.x_coord - edge_x if self.ball.x_speed < 0 else self.ball.x_coord - (self.screen_width - edge_x)
-        )
-        desired_offset_y = (
-            self.ball.y_coord - edge_y if self.ball.y_speed < 0 else self.ball.y_coord - (self.screen_height - edge_y)
-        )
-
-        # Smoothing factor
-        alpha = BALL_SPEED / 150
-
-        # Update camera offsets using linear interpolation for smoother movement
-        self.offset_x = lerp(self.offset_x, desired_offset_x, alpha)
-        self.offset_y = lerp(self.offset_y, desired_offset_y, alpha)
+        ball = self.ball
+        # Desired offsets based on ball's position, then linear interpolation towards them for smoother movement
+        desired_offset_x = ball.x_coord - (self._camera_lead_left if ball.x_speed < 0 else self._camera_lead_right)
+        desired_offset_y = ball.y_coord - (self._camera_lead_up if ball.y_speed < 0 else self._camera_lead_down)
+        self.offset_x += (desired_offset_x - self.offset_x) * CAMERA_ALPHA
+        self.offset_y += (desired_offset_y - self.offset_y) * CAMERA_ALPHA
 
     @staticmethod
     def create_squares(list_of_x_coords, list_of_y_coords):
-        list_of_x_coords = sorted(list_of_x_coords)
-        list_of_y_coords = sorted(list_of_y_coords)
-        return [
-            [x, y, x2 - x, y2 - y]
-            for x, x2 in zip(list_of_x_coords[:-1], list_of_x_coords[1:])
-            for y, y2 in zip(list_of_y_coords[:-1], list_of_y_coords[1:])
-            if x2 - x and y2 - y
-        ]
+        """Every cell of the grid the coordinates make, as [x, y, width, height] rows going down each column."""
+        # Cells with no width or height get skipped, that's the same as only keeping the distinct coordinates
+        xs = np.unique(list_of_x_coords)
+        ys = np.unique(list_of_y_coords)
+        squares = np.empty((len(xs) - 1, len(ys) - 1, 4), dtype=xs.dtype)
+        squares[..., 0] = xs[:-1, None]
+        squares[..., 1] = ys[None, :-1]
+        squares[..., 2] = np.diff(xs)[:, None]
+        squares[..., 3] = np.diff(ys)[None, :]
+        return squares.reshape(-1, 4)
 
     def place_walls(self):
         list_of_x_coords = []
@@ -640,13 +836,13 @@ class Scene:
             list_of_y_coords += [platform.y_coord, platform.y_coord + platform.height]
 
         walls = self.create_squares(list_of_x_coords, list_of_y_coords)
-        for x, y, W, H in walls:
+        for x, y, W, H in walls.tolist():
             self.walls.append(Wall(x, y, W, H, WALL_COLOR))
         # Find the minimum and maximum extents of existing walls
-        minX = min(w[0] for w in walls)
-        maxX = max(w[0] + w[2] for w in walls)
-        minY = min(w[1] for w in walls)
-        maxY = max(w[1] + w[3] for w in walls)
+        minX = walls[:, 0].min().item()
+        maxX = (walls[:, 0] + walls[:, 2]).max().item()
+        minY = walls[:, 1].min().item()
+        maxY = (walls[:, 1] + walls[:, 3]).max().item()
 
         WS = SCREEN_WIDTH * 2
         HS = SCREEN_HEIGHT * 2
@@ -661,6 +857,12 @@ class Scene:
             self.walls.append(ew)
 
     def render_full_image(self):
+        if not self.platforms:
+            return None
+        set_static_walls(self.walls_layer())
+        return Image.fromarray(rasterize_frame(self.record_full_frame()))
+
+    def record_full_frame(self):
         if not self.platforms:
             return None
 
@@ -672,10 +874,12 @@ class Scene:
         img_width = max_x - min_x
         img_height = max_y - min_y
 
-        image = Image.new("RGB", (img_width, img_height), BG_COLOR)
-        draw = ImageDraw.Draw(image)
+        draw = FrameRecorder("RGB", (img_width, img_height))
 
-        for wall in self.walls:
+        if self.carved:
+            draw.background = (min_x, min_y)
+
+        for wall in [] if self.carved else self.walls:
             if not wall.visible:
                 continue
             draw.rectangle(
@@ -699,9 +903,9 @@ class Scene:
                 fill=platform.get_color(),
             )
 
-        self.ball.render(image, min_x, min_y)
+        self.ball.render(draw, min_x, min_y)
 
-        return image
+        return draw
 
     def run_simulation(
         self,
@@ -715,28 +919,42 @@ class Scene:
         sustain_pedal=False,
         zoomed_out=False,
         bump_paddles=False,
+        workers=1,
     ):
         video_file = f"{get_cache_dir()}/{filename}.mp4"
-        writer = imageio.get_writer(video_file, fps=FPS)
+        record_frame = self.record_full_frame if zoomed_out else self.record_frame
 
-        for _ in range(num_frames):
-            self.update(change_colors, bump_paddles=bump_paddles)
+        # Without a video, nothing gets drawn, so there's no writer (or workers) to start up
+        frame_writer = contextlib.nullcontext()
+        if save_video:
+            writer = get_video_writer(video_file, FPS)
+            # The scene is stepped here, while the recorded frames are rasterized by the worker processes
+            frame_writer = ParallelFrameWriter(
+                writer,
+                rasterize_frame,
+                workers,
+                initializer=set_static_walls,
+                initargs=(self.walls_layer(),),
+            )
+
+        with frame_writer:
             if save_video:
-                if zoomed_out:
-                    writer.append_data(np.array(self.render_full_image()))
-                else:
-                    writer.append_data(np.array(self.render()))
-            progress = (self.frame_count / num_frames) * 100
-            click.echo(f"\r{progress:0.0f}% ({self.frame_count} frames)", nl=False)
+                # The music only depends on the midi, so it's rendered while the frames are.
+                # It's started once the workers are, so they aren't forked while its thread is running
+                music = start_music(midi, SOUND_FONT_FILE_BETTER, new_instrument, isolated_tracks, sustain_pedal)
+            for _ in range(num_frames):
+                self.update(change_colors, bump_paddles=bump_paddles)
+                if save_video:
+                    frame_writer.append(record_frame())
+                progress = (self.frame_count / num_frames) * 100
+                click.echo(f"\r{progress:0.0f}% ({self.frame_count} frames)", nl=False)
 
-        if save_video:
-            # "Pause" for a few seconds
-            for _ in range(FPS * END_VIDEO_FREEZE_SECONDS):
-                if zoomed_out:
-                    writer.append_data(np.array(self.render_full_image()))
-                else:
-                    writer.append_data(np.array(self.render()))
+            if save_video:
+                # "Pause" for a few seconds
+                for _ in range(FPS * END_VIDEO_FREEZE_SECONDS):
+                    frame_writer.append(record_frame())
 
+        if save_video:
             click.echo(f"\nGenerating the {filename} video...")
             vid_name = finalize_video_with_music(
                 writer,
@@ -750,77 +968,178 @@ class Scene:
                 new_instrument,
                 isolated_tracks,
                 sustain_pedal,
+                music=music,
             )
             # self.render_full_image().save(f"{vid_name.split('.mp4')[0]}.png")
 
 
-def choices_are_valid(note_frames, boolean_choice_list):
-    choices = {}
-    frame_list = sorted(list(note_frames))
-    for idx, choice in enumerate(boolean_choice_list):
-        choices[frame_list[idx]] = choice
-    num_frames = max(choices.keys())
+def copy_platforms(platforms):
+    copies = []
+    for platform in platforms:
+        copy = Platform(platform.x_coord, platform.y_coord, platform.width, platform.height, platform.color)
+        copy.reset_expected_bounce_frame(platform.expected_bounce_frame())
+        copies.append(copy)
+    return copies
 
-    # First - Run Choices through empty Environment to place the Platforms
-    ball = Ball(BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED, show_carve=False, fill_color=BALL_FILL)
-    scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames, choices)
-    for _ in range(num_frames):
-        scene.update()
 
-    # Then - Check if Scene is valid when platforms placed at start
-    ball = Ball(BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED, show_carve=False, fill_color=BALL_FILL)
-    platforms = scene.platforms
-    scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball)
-    scene.set_platforms(platforms)
-    try:
-        for _ in range(num_frames):
-            scene.update()
-    except BadSimulation:
-        return False
-
-    return True
-
-
-def get_valid_platform_choices(strategy, note_frames: set, boolean_choice_list: list = []):
-    if not boolean_choice_list:
-        boolean_choice_list.append(random.choice([True, False]))
-
-    progress_string = "".join(["─" if i else "|" for i in boolean_choice_list])
-    prog_length = 60
-    expected = len(note_frames)
-    actual = len(boolean_choice_list)
-    progress = int((actual / expected) * 100)
-    trunc = f"({len(progress_string)-prog_length}):" if len(progress_string) >= prog_length else ""
-    click.echo(f"\rProgress: {progress}%\t{trunc}{progress_string[-(prog_length-len(trunc)):]}", nl=False)
-    if len(boolean_choice_list) == len(note_frames):
-        if choices_are_valid(note_frames, boolean_choice_list):
-            return boolean_choice_list
-        else:
+class ChoiceChecker:
+    """
+    Checks the platform choices one at a time, for the backtracking search.
+
+    Instead of replaying every choice from the first frame, both simulations (placing the platforms, and then
+    checking the ball bounces off them on the right frames) carry on from the state saved after the last choice,
+    and get rolled back to it when the search backtracks.
+    """
+
+    def __init__(self, note_frames):
+        self.frame_list = sorted(note_frames)
+
+        ball = Ball(
+            BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED, show_carve=False, fill_color=BALL_FILL
+        )
+        self.placing = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames, {})
+
+        ball = Ball(
+            BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED, show_carve=False, fill_color=BALL_FILL
+        )
+        self.checking = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball)
+        self._checking_start = self.checking.save_state()
+
+        # Placing state: (scene state, expected bounce frame of each platform)
+        # Checking state: (scene state, ball positions on each frame so far, whether to replay from the start)
+        no_positions = np.empty(0, dtype=int)
+        self.start_state = (
+            (self.placing.save_state(), []),
+            (self._checking_start, no_positions, no_positions, False),
+        )
+
+    def try_choice(self, state, choice):
+        """Add the next choice after the given state, returns the new state or None if the choice is not valid."""
+        placing_state, checking_state = state
+        frame = self._load_placing(placing_state)
+        self.placing._platform_orientations[frame] = choice
+        while self.placing.frame_count < frame:
+            self.placing.update()
+        placing_state = (
+            self.placing.save_state(),
+            [platform.expected_bounce_frame() for platform in self.placing.platforms],
+        )
+
+        checking_state = self._check(checking_state, frame)
+        if checking_state is None:
+            return None
+        return placing_state, checking_state
+
+    def order_choices(self, state, choices):
+        """Sort the choices for the next note, the ones that put its platform furthest from the others come first."""
+        frame = self._load_placing(state[0])
+        platforms = self.placing.platforms
+        if not platforms:
+            return choices
+
+        # Run up to the frame the platform gets placed on, both orientations start from the same ball position
+        while self.placing.frame_count < frame - 1:
+            self.placing.update()
+        centers = np.array([(p.x_coord + p.width / 2, p.y_coord + p.height / 2) for p in platforms])
+
+        def distance_to_platforms(choice):
+            new = self.placing.next_platform(choice)
+            return np.hypot(
+                centers[:, 0] - (new.x_coord + new.width / 2),
+                centers[:, 1] - (new.y_coord + new.height / 2),
+            ).min()
+
+        return sorted(choices, key=distance_to_platforms, reverse=True)
+
+    def _load_placing(self, placing_state):
+        """Roll the placing scene back to the given state, returns the frame of the next note."""
+        scene_state, expected_frames = placing_state
+        self.placing.load_state(scene_state)
+        self.placing.truncate_platforms(len(expected_frames))
+        for platform, frame in zip(self.placing.platforms, expected_frames):
+            platform.reset_expected_bounce_frame(frame)
+        return self.frame_list[len(expected_frames)]
+
+    def _check(self, checking_state, num_frames):
+        scene_state, ball_xs, ball_ys, replay = checking_state
+        platforms = copy_platforms(self.placing.platforms)
+
+        # Carrying on only gives the same result as a full replay when the new platform is nowhere the ball
+        # has already been, and no platform got hit before its bounce frame was known
+        new = platforms[-1]
+        ball_size = self.checking.ball.width
+        if replay or np.any(
+            (ball_xs + ball_size >= new.x_coord)
+            & (ball_xs <= new.x_coord + new.width)
+            & (ball_ys + ball_size >= new.y_coord)
+            & (ball_ys <= new.y_coord + new.height)
+        ):
+            scene_state, ball_xs, ball_ys = self._checking_start, ball_xs[:0], ball_ys[:0]
+
+        self.checking.load_state(scene_state)
+        self.checking.set_platforms(platforms)
+        unknown = [platform for platform in platforms if platform.expected_bounce_frame() is None]
+
+        xs, ys = [], []
+        try:
+            while self.checking.frame_count < num_frames:
+                xs.append(self.checking.ball.x_coord)
+                ys.append(self.checking.ball.y_coord)
+                self.checking.update()
+        except BadSimulation:
             return None
 
-    # Check if the current partial string is valid
-    if not choices_are_valid(note_frames, boolean_choice_list):
-        # Prune the search tree here
-        return None
+        return (
+            self.checking.save_state(),
+            np.concatenate([ball_xs, xs]),
+            np.concatenate([ball_ys, ys]),
+            any(platform.expected_bounce_frame() is not None for platform in unknown),
+        )
 
-    if strategy == STRATEGY_ALTERNATE:
-        if boolean_choice_list[-1]:
-            next_choices = [False, True]
-        else:
+
+def get_valid_platform_choices(strategy, note_frames: set):
+    # Depth first search over the choices, using an explicit stack of the choices still to visit (with their depth),
+    # along with the saved state to try each one from
+    checker = ChoiceChecker(note_frames)
+    boolean_choice_list = []
+    stack = [(0, random.choice([True, False]), checker.start_state)]
+    while stack:
+        depth, choice, parent_state = stack.pop()
+        # Backtrack the shared choice list to the parent of this entry, and add its choice
+        del boolean_choice_list[depth:]
+        boolean_choice_list.append(choice)
+
+        prog_length = 60
+        progress_string = "".join(["─" if i else "|" for i in boolean_choice_list[-prog_length:]])
+        expected = len(note_frames)
+        actual = len(boolean_choice_list)
+        progress = int((actual / expected) * 100)
+        trunc = f"({actual-prog_length}):" if actual >= prog_length else ""
+        click.echo(f"\rProgress: {progress}%\t{trunc}{progress_string[-(prog_length-len(trunc)):]}", nl=False)
+        state = checker.try_choice(parent_state, boolean_choice_list[-1])
+        if state is None:
+            # Prune the search tree here
+            continue
+
+        if len(boolean_choice_list) == len(note_frames):
+            # The checker's placing scene ran every choice, so its platforms are the ones to use
+            return boolean_choice_list, checker.placing.platforms
+
+        if strategy == STRATEGY_ALTERNATE:
+            if boolean_choice_list[-1]:
+                next_choices = [False, True]
+            else:
+                next_choices = [True, False]
+        elif strategy == STRATEGY_RANDOM:
             next_choices = [True, False]
-    elif strategy == STRATEGY_RANDOM:
-        next_choices = [True, False]
-        if random.choice([True, False]):
-            next_choices = next_choices[::-1]
-
-    for rand_choice in next_choices:
-        result = get_valid_platform_choices(
-            strategy,
-            note_frames,
-            boolean_choice_list + [rand_choice],
-        )
-        if result is not None:
-            return result
+            if random.choice([True, False]):
+                next_choices = next_choices[::-1]
+        elif strategy == STRATEGY_SPREAD:
+            next_choices = checker.order_choices(state, [True, False])
+
+        # Push in reverse, so the first choice is the next one popped
+        for next_choice in reversed(next_choices):
+            stack.append((actual, next_choice, state))
 
     return None
 
@@ -902,7 +1221,14 @@ def parse_animate_tracks(ctx, param, value):
     "--strategy",
     "-s",
     default=STRATEGY_RANDOM,
-    help='"random" or "alternate" for platform orientation placement',
+    help='"random", "alternate" or "spread" for platform orientation placement',
+)
+@click.option(
+    "--workers",
+    "-w",
+    default=os.cpu_count(),
+    type=int,
+    help="Number of processes used to render the video frames",
 )
 def main(
     midi,
@@ -915,6 +1241,7 @@ def main(
     sustain_pedal,
     zoomed_out,
     strategy,
+    workers,
 ):
     song_name = midi.split("/")[-1].split(".mid")[0]
     # Inspect the MIDI file to see which video frames line up with the music
@@ -930,11 +1257,12 @@ def main(
     # Run the backtracking alg to figure out where to place the platforms
     num_platforms = len(note_frames)
     click.echo(f"Searching for valid placement for {num_platforms} platforms...")
-    boolean_choice_list = get_valid_platform_choices(strategy, note_frames)
-    if not boolean_choice_list:
+    search_result = get_valid_platform_choices(strategy, note_frames)
+    if not search_result:
         click.echo("\nCould not figure out platforms :(")
         click.echo("\nTry changing ball and platform size, and speed")
         exit(0)
+    boolean_choice_list, platforms = search_result
 
     # Convert `boolean_choice_list` to `choices`
     # Choices is DICT, KEY=FRAME NUMBER, VAL=Bool for if the platform hit on this frame is Horizontal or Vertical
@@ -944,10 +1272,23 @@ def main(
         choices[frame_list[idx]] = choice
     num_frames = max(choices.keys())
 
-    click.echo(f"\nRunning simulation to place {num_platforms} platforms...")
     ball = Ball(BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED, show_carve=False, fill_color=BALL_FILL)
     scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames, choices)
-    scene.run_simulation(midi, f"{song_name}-platforms", num_frames, show_platform, new_instrument, isolated_tracks)
+    if show_platform:
+        click.echo(f"\nRunning simulation to place {num_platforms} platforms...")
+        scene.run_simulation(
+            midi,
+            f"{song_name}-platforms",
+            num_frames,
+            show_platform,
+            new_instrument,
+            isolated_tracks,
+            workers=workers,
+        )
+        platforms = scene.platforms
+    else:
+        # The search already ran the simulation that places the platforms, no need to run it again
+        scene.set_platforms(platforms)
 
     # After the platforms are placed in the first simulation, place the walls
     scene.place_walls()
@@ -955,14 +1296,21 @@ def main(
 
     # Run the next simulation with the platforms and walls in place, and carve the walls
     click.echo(f"\nRunning the simulation again to carve {len(walls)} walls)...")
-    platforms = scene.platforms
     ball = Ball(
         BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED, show_carve=show_carve, fill_color=BALL_FILL
     )
     scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames)
     scene.set_platforms(platforms)
     scene.set_walls(walls)
-    scene.run_simulation(midi, f"{song_name}", num_frames, show_carve, new_instrument, isolated_tracks)
+    scene.run_simulation(
+        midi,
+        f"{song_name}",
+        num_frames,
+        show_carve,
+        new_instrument,
+        isolated_tracks,
+        workers=workers,
+    )
 
     # Run the final simulation with the platforms and carved walls in place
     carved_walls = scene.walls
@@ -982,6 +1330,7 @@ def main(
         bump_paddles=True,
         sustain_pedal=sustain_pedal,
         zoomed_out=zoomed_out,
+        workers=workers,
     )
 
     cleanup_cache_dir()
@@ -1,7 +1,12 @@
+import contextlib
+import itertools
+import math
+from collections import deque
+
 from PIL import Image, ImageDraw
 import click
-import imageio
 import numpy as np
+from numba import njit
 
 from ursina import *
 
@@ -9,10 +14,11 @@ from src.midi_stuff import (
     get_frames_where_notes_happen,
     SOUND_FONT_FILE_BETTER,
 )
-from src.video_stuff import finalize_video_with_music
+from src.video_stuff import copy_frame, finalize_video_with_music, get_video_writer, ParallelFrameWriter, start_music
 from src.cache_stuff import get_cache_dir, cleanup_cache_dir
 from src.animation_stuff import lerp, animate_throb
 from src.color_stuff import hex_to_rgba
+from src.physics_stuff import PlatformGrid
 
 # BG_COLOR = "#d6d1cd"
 BG_COLOR = "#a8a8a8"
@@ -59,6 +65,14 @@ ALPHA = BALL_SPEED / 8
 FPS = 60
 FRAME_BUFFER = 15
 
+# Platforms and the ball fit in a cell, so each one only touches up to 4 cells
+PLATFORM_GRID_CELL = 2 * max(PLATFORM_HEIGHT, BALL_SIZE)
+
+# The walls are bucketed into a grid too, for carving. Walls covering more cells than that (like the walls
+# around the edges) are checked every time instead
+WALL_GRID_CELL = 4
+WALL_GRID_MAX_CELLS = 64
+
 
 app = Ursina()
 
@@ -88,24 +102,66 @@ def merge_rectangles(rectangles):
 
         return None
 
+    # Each pass takes the rectangles in order, and merges each one with the rectangles after it in the queue,
+    # checking them in order. Instead of comparing it with every one of them, the rectangles are looked up by
+    # the edges `merged` compares, so only the (up to 4) rectangles it lines up with get checked.
+    # Rectangles are numbered in the order they join the queue, so the queue order is the order of their numbers.
+    def edge_keys(rect):
+        x, y, w, h = rect
+        return (x, y, w), (x, y + h, w), (x, y, h), (x + w, y, h)
+
     changed = True
     while changed:
         changed = False
         new_rectangles = []
-        while rectangles:
-            rect = rectangles.pop(0)
+        queue = deque()
+        queued = {}  # number -> rectangle, for the rectangles still in the queue
+        tops, bottoms, lefts, rights = {}, {}, {}, {}
+        edge_indexes = (tops, bottoms, lefts, rights)
+        numbers = itertools.count()
+
+        def push(rect):
+            number = next(numbers)
+            queue.append(number)
+            queued[number] = rect
+            for index, key in zip(edge_indexes, edge_keys(rect)):
+                index.setdefault(key, set()).add(number)
+
+        def take(number):
+            rect = queued.pop(number)
+            for index, key in zip(edge_indexes, edge_keys(rect)):
+                index[key].discard(number)
+            return rect
+
+        for rect in rectangles:
+            push(rect)
+
+        while queue:
+            number = queue.popleft()
+            if number not in queued:
+                # Already merged into another rectangle
+                continue
+            rect = take(number)
             merged_any = False
-            i = 0
-            while i < len(rectangles):
-                result = merged(rect, rectangles[i])
-                if result:
-                    rect = result  # Update rect to the merged result
-                    rectangles.pop(i)  # Remove the merged rectangle
-                    merged_any = True
-                else:
-                    i += 1
+            # Where the scan through the rest of the queue is up to
+            scanned = number
+            while True:
+                x, y, w, h = rect
+                # Rectangles below, above, right and left of rect
+                candidates = (
+                    tops.get((x, y + h, w), ()),
+                    bottoms.get((x, y, w), ()),
+                    lefts.get((x + w, y, h), ()),
+                    rights.get((x, y, h), ()),
+                )
+                later = [other for found in candidates for other in found if other > scanned]
+                if not later:
+                    break
+                scanned = min(later)
+                rect = merged(rect, take(scanned))  # Update rect to the merged result
+                merged_any = True
             if merged_any:
-                rectangles.append(rect)  # Add the updated rect back for further merging
+                push(rect)  # Add the updated rect back for further merging
                 changed = True
             else:
                 new_rectangles.append(rect)  # No merge, this rect is final for this pass
@@ -115,34 +171,52 @@ def merge_rectangles(rectangles):
     return rectangles
 
 
-def create_mesh(vertices, depth, z):
-    num_vertices = len(vertices)
-    vertices3d = [Vec3(v.x, v.y, z) for v in vertices]
-    vertices3d += [Vec3(v.x, v.y, z - depth) for v in vertices]
-
-    triangles = []
-
-    # Front face triangles
-    for i in range(1, num_vertices - 1):
-        triangles.append([0, i, i + 1])
-
-    # Back face triangles
+def create_mesh(polygons):
+    """
+    One mesh for all the `polygons`, given as (vertices, z, depth), each one extruded from z back to z - depth.
+    The polygons all need the same number of vertices.
+    """
+    corners = np.array([[(v.x, v.y) for v in vertices] for vertices, _, _ in polygons], dtype=float)
+    z = np.array([z for _, z, _ in polygons], dtype=float)
+    depth = np.array([depth for _, _, depth in polygons], dtype=float)
+    num_polygons, num_vertices = corners.shape[:2]
+
+    # The front face's vertices, then the back face's, for each polygon
+    vertices3d = np.empty((num_polygons, 2 * num_vertices, 3))
+    vertices3d[:, :num_vertices, :2] = corners
+    vertices3d[:, :num_vertices, 2] = z[:, None]
+    vertices3d[:, num_vertices:, :2] = corners
+    vertices3d[:, num_vertices:, 2] = (z - depth)[:, None]
+
+    # The triangles of one polygon, shifted along to each polygon's vertices
     offset = num_vertices
-    for i in range(1, num_vertices - 1):
-        triangles.append([offset, offset + i + 1, offset + i])
-
-    # Side triangles
-    for i in range(num_vertices):
-        next_index = (i + 1) % num_vertices
-        triangles.append([i, offset + i, offset + next_index])
-        triangles.append([i, offset + next_index, next_index])
+    fan = np.arange(1, num_vertices - 1)
+    sides = np.arange(num_vertices)
+    next_sides = (sides + 1) % num_vertices
+    triangles = np.concatenate(
+        [
+            # Front face triangles
+            np.stack([np.zeros_like(fan), fan, fan + 1], axis=1),
+            # Back face triangles
+            np.stack([np.full_like(fan, offset), offset + fan + 1, offset + fan], axis=1),
+            # Side triangles
+            np.stack(
+                [
+                    np.stack([sides, offset + sides, offset + next_sides], axis=1),
+                    np.stack([sides, offset + next_sides, next_sides], axis=1),
+                ],
+                axis=1,
+            ).reshape(-1, 3),
+        ]
+    )
+    triangles = triangles[None] + (2 * num_vertices * np.arange(num_polygons))[:, None, None]
 
-    return Mesh(vertices=vertices3d, triangles=triangles)
+    return Mesh(vertices=vertices3d.reshape(-1, 3).tolist(), triangles=triangles.reshape(-1, 3).tolist())
 
 
 class CustomWall(Entity):
-    def __init__(self, vertices, z, depth, color):
-        super().__init__(model=create_mesh(vertices, depth, z), color=color)
+    def __init__(self, polygons, color, **kwargs):
+        super().__init__(model=create_mesh(polygons), color=color, **kwargs)
 
 
 class BadSimulation(Exception):
@@ -183,23 +257,14 @@ class Thing:
     def hide(self):
         self.visible = False
 
-    def render(self, offset_x, offset_y):
-        if not self.visible:
-            return
-
+    def polygon(self, offset_x, offset_y):
+        """The front face of the thing, where it is drawn at these offsets, with its z and depth for create_mesh."""
         x, y = (self.x_coord - offset_x, self.y_coord - offset_y)
 
         z_fight = 0.001 * float(self.index)
 
         vertices = calculate_vertices(x, y, self.width, self.height)
-        CustomWall(
-            vertices,
-            z=self.depth - 1 - z_fight,
-            depth=self.depth,
-            color=hex_to_rgba(self.color),
-        )
-        if self.color_changed:
-            PointLight(position=(x, y, self.depth - 0.5), color=color.white)
+        return vertices, self.depth - 1 - z_fight, self.depth
 
     def in_frame(self, visible_bounds):
         """Check if the object is within the visible bounds."""
@@ -241,41 +306,59 @@ class Ball(Thing):
         self.current_size = size
         self.size_fade_frames_remaining = 0
 
+        # The color and the hit animation never change, so work them out once up front
+        self._rgba = hex_to_rgba(color)
+        self._size_seq = [self.original_size]
+        for frames_remaining in range(1, HIT_ANIMATION_LENGTH + 1):
+            throb = animate_throb(
+                -frames_remaining,
+                peak=HIT_ANIMATION_LENGTH / 2,
+                width=HIT_ANIMATION_LENGTH * 2,
+            )
+            self._size_seq.append(self.original_size * (1 - HIT_SHRINK * (throb / HIT_ANIMATION_LENGTH)))
+
         self._carve_top_left_corner = None
         self._carve_top_right_corner = None
         self._carve_bottom_left_corner = None
         self._carve_bottom_right_corner = None
         self._initialize_carve_square()
 
+        # The ball's cube and the lights around it, made on the first render and moved on every frame after that
+        self._entity = None
+        self._lights = []
+
     def hit(self):
         self.size_fade_frames_remaining = HIT_ANIMATION_LENGTH
 
     def render(self, offset_x, offset_y):
+        self.current_size = self._size_seq[self.size_fade_frames_remaining]
         if self.size_fade_frames_remaining > 0:
-            throb = animate_throb(
-                -self.size_fade_frames_remaining,
-                peak=HIT_ANIMATION_LENGTH / 2,
-                width=HIT_ANIMATION_LENGTH * 2,
-            )
-            factor = 1 - HIT_SHRINK * (throb / HIT_ANIMATION_LENGTH)
-            self.current_size = self.original_size * factor
             self.size_fade_frames_remaining -= 1
-        else:
-            self.current_size = self.original_size
 
         x, y = (self.x_coord - offset_x, self.y_coord - offset_y)
         y += self.current_size / 2
         x += self.current_size / 2
-        Entity(
-            model="cube",
-            position=(x, y, self.depth),
-            scale=(self.current_size, self.current_size, self.current_size),
-            color=hex_to_rgba(self.get_color()),
-        )
-        PointLight(position=(x, y, self.depth), color=color.white)
-        PointLight(position=(BALL_START_X - offset_x, BALL_START_Y - offset_y, self.depth), color=color.white)
-        PointLight(position=(BALL_START_X - offset_x, BALL_START_Y - offset_y, self.depth - 5), color=color.white)
-        PointLight(position=(BALL_START_X - offset_x, BALL_START_Y - offset_y, -self.depth), color=color.white)
+        if self._entity is None:
+            # Eternal, so scene.clear() leaves them in the scene
+            self._entity = Entity(model="cube", color=self._rgba, eternal=True)
+            self._lights = [PointLight(color=color.white, eternal=True) for _ in range(4)]
+        self._entity.position = (x, y, self.depth)
+        self._entity.scale = (self.current_size, self.current_size, self.current_size)
+        light_positions = [
+            (x, y, self.depth),
+            (BALL_START_X - offset_x, BALL_START_Y - offset_y, self.depth),
+            (BALL_START_X - offset_x, BALL_START_Y - offset_y, self.depth - 5),
+            (BALL_START_X - offset_x, BALL_START_Y - offset_y, -self.depth),
+        ]
+        for light, position in zip(self._lights, light_positions):
+            light.position = position
+
+    def destroy_entities(self):
+        for entity in [self._entity, *self._lights]:
+            if entity is not None:
+                destroy(entity)
+        self._entity = None
+        self._lights = []
 
     def get_color(self):
         return self.original_color
@@ -285,12 +368,11 @@ class Ball(Thing):
         future_y = self.y_coord + self.y_speed * frames
         return future_x, future_y
 
-    def move(self, platforms, walls, frame, visible_bounds):
+    def move(self, platforms, frame, visible_bounds):
         # Calculate potential next position of the ball
         next_x = self.x_coord
         next_y = self.y_coord
         hit_platform = None
-        is_carving = len(walls) > 0
 
         for platform in platforms:
             if not platform.in_frame(visible_bounds):
@@ -312,18 +394,15 @@ class Ball(Thing):
                 and ball_bottom >= plat_top
                 and ball_top <= plat_bottom
             ):
-                overlap_left = ball_right - plat_left
-                overlap_right = plat_right - ball_left
-                overlap_top = ball_bottom - plat_top
-                overlap_bottom = plat_bottom - ball_top
-
-                min_overlap = min(overlap_left, overlap_right, overlap_top, overlap_bottom)
+                # The ball bounces off whichever side it overlaps the least
+                min_overlap_x = min(ball_right - plat_left, plat_right - ball_left)
+                min_overlap_y = min(ball_bottom - plat_top, plat_bottom - ball_top)
 
                 if platform.orientation:
-                    if min_overlap == overlap_top or min_overlap == overlap_bottom:
+                    if min_overlap_y <= min_overlap_x:
                         self.y_speed = -self.y_speed
                 else:
-                    if min_overlap == overlap_left or min_overlap == overlap_right:
+                    if min_overlap_x <= min_overlap_y:
                         self.x_speed = -self.x_speed
 
                 platform.set_expected_bounce_frame(frame)
@@ -335,44 +414,21 @@ class Ball(Thing):
         self.x_coord += self.x_speed
         self.y_coord += self.y_speed
 
-        if is_carving and hit_platform:
-            self._initialize_carve_square()
+        return hit_platform
 
-        for wall in walls:
-            if not wall.in_frame(visible_bounds):
-                continue
-            # Get the minimum and maximum x and y values from the carving corners
-            ball_left = min(self._carve_top_left_corner[0], self._carve_bottom_left_corner[0])
-            ball_right = max(self._carve_top_right_corner[0], self._carve_bottom_right_corner[0])
-            ball_top = min(self._carve_top_left_corner[1], self._carve_top_right_corner[1])
-            ball_bottom = max(self._carve_bottom_left_corner[1], self._carve_bottom_right_corner[1])
+    def carve(self, walls, visible_bounds, hit_platform):
+        """Hide the walls touching the carving square (and the platform that was hit), then grow the square."""
+        if hit_platform:
+            self._initialize_carve_square()
 
-            # Check collision with wall
-            if (
-                ball_right >= wall.x_coord
-                and ball_left <= wall.x_coord + wall.width
-                and ball_bottom >= wall.y_coord
-                and ball_top <= wall.y_coord + wall.height
-            ):
-                wall.hide()
-
-            if hit_platform:
-                plat_left = hit_platform.x_coord
-                plat_right = hit_platform.x_coord + hit_platform.width
-                plat_top = hit_platform.y_coord
-                plat_bottom = hit_platform.y_coord + hit_platform.height
-                if (
-                    plat_right > wall.x_coord
-                    and plat_left < wall.x_coord + wall.width
-                    and plat_bottom > wall.y_coord
-                    and plat_top < wall.y_coord + wall.height
-                ):
-                    wall.hide()
-
-        if is_carving:
-            self._update_carve_square()
+        # Get the minimum and maximum x and y values from the carving corners
+        ball_left = min(self._carve_top_left_corner[0], self._carve_bottom_left_corner[0])
+        ball_right = max(self._carve_top_right_corner[0], self._carve_bottom_right_corner[0])
+        ball_top = min(self._carve_top_left_corner[1], self._carve_top_right_corner[1])
+        ball_bottom = max(self._carve_bottom_left_corner[1], self._carve_bottom_right_corner[1])
+        walls.hide_touching(visible_bounds, (ball_left, ball_top, ball_right, ball_bottom), hit_platform)
 
-        return hit_platform
+        self._update_carve_square()
 
     def _initialize_carve_square(self):
         self._carve_top_left_corner = (self.x_coord, self.y_coord)
@@ -407,6 +463,100 @@ class Ball(Thing):
             self._carve_top_left_corner = (self.x_coord - 1, self.y_coord - 1)
 
 
+class WallCarver:
+    """
+    The walls as arrays of their edges, so the ball carves through them with a few array comparisons.
+    Only the walls sharing a grid cell with what is carving them get compared.
+    """
+
+    def __init__(self, walls):
+        self.walls = walls
+        self._left = np.array([wall.x_coord for wall in walls], dtype=float)
+        self._top = np.array([wall.y_coord for wall in walls], dtype=float)
+        self._right = np.array([wall.x_coord + wall.width for wall in walls], dtype=float)
+        self._bottom = np.array([wall.y_coord + wall.height for wall in walls], dtype=float)
+        self._visible = np.array([wall.visible for wall in walls], dtype=bool)
+
+        # The cells each wall covers, from (cell_left, cell_top) to (cell_right, cell_bottom)
+        cell_left, cell_top, cell_right, cell_bottom = (
+            np.floor(edge / WALL_GRID_CELL).astype(np.int64)
+            for edge in (self._left, self._top, self._right, self._bottom)
+        )
+        columns = cell_right - cell_left + 1
+        num_cells = columns * (cell_bottom - cell_top + 1)
+        bucketed = num_cells <= WALL_GRID_MAX_CELLS
+        self._unbucketed = np.flatnonzero(~bucketed)
+
+        # A (cell, wall) pair for every cell each bucketed wall covers, grouped by cell
+        pair_walls = np.repeat(np.flatnonzero(bucketed), num_cells[bucketed])
+        first_pairs = np.cumsum(num_cells[bucketed]) - num_cells[bucketed]
+        cell_number = np.arange(len(pair_walls)) - np.repeat(first_pairs, num_cells[bucketed])
+        pair_x = cell_left[pair_walls] + cell_number % columns[pair_walls]
+        pair_y = cell_top[pair_walls] + cell_number // columns[pair_walls]
+        order = np.lexsort((pair_walls, pair_y, pair_x))
+        pair_x, pair_y, pair_walls = pair_x[order], pair_y[order], pair_walls[order]
+        new_cell = np.ones(len(pair_walls), dtype=bool)
+        new_cell[1:] = (pair_x[1:] != pair_x[:-1]) | (pair_y[1:] != pair_y[:-1])
+        cell_starts = np.flatnonzero(new_cell)
+        self._walls_by_cell = dict(
+            zip(
+                zip(pair_x[cell_starts].tolist(), pair_y[cell_starts].tolist()),
+                np.split(pair_walls, cell_starts[1:]),
+            )
+        )
+
+    def near(self, left, top, right, bottom):
+        """Indexes (in order) of the walls that could touch the box."""
+        found = [self._unbucketed]
+        for cell_x in range(math.floor(left / WALL_GRID_CELL), math.floor(right / WALL_GRID_CELL) + 1):
+            for cell_y in range(math.floor(top / WALL_GRID_CELL), math.floor(bottom / WALL_GRID_CELL) + 1):
+                walls_in_cell = self._walls_by_cell.get((cell_x, cell_y))
+                if walls_in_cell is not None:
+                    found.append(walls_in_cell)
+        return np.unique(np.concatenate(found))
+
+    def hide_touching(self, visible_bounds, box, platform=None):
+        """
+        Hide the walls within the visible bounds that touch the box, or overlap the platform.
+        Touching the edge of the box is enough, but the platform has to overlap the wall.
+        """
+        visible_left, visible_right, visible_top, visible_bottom = visible_bounds
+        left, top, right, bottom = box
+        indexes = self.near(left, top, right, bottom)
+        if platform:
+            platform_box = (
+                platform.x_coord,
+                platform.y_coord,
+                platform.x_coord + platform.width,
+                platform.y_coord + platform.height,
+            )
+            indexes = np.union1d(indexes, self.near(*platform_box))
+
+        wall_left = self._left[indexes]
+        wall_top = self._top[indexes]
+        wall_right = self._right[indexes]
+        wall_bottom = self._bottom[indexes]
+        touching = (right >= wall_left) & (left <= wall_right) & (bottom >= wall_top) & (top <= wall_bottom)
+        if platform:
+            touching |= (
+                (platform_box[2] > wall_left)
+                & (platform_box[0] < wall_right)
+                & (platform_box[3] > wall_top)
+                & (platform_box[1] < wall_bottom)
+            )
+        touching &= (
+            self._visible[indexes]
+            & (wall_right >= visible_left)
+            & (wall_left <= visible_right)
+            & (wall_bottom >= visible_top)
+            & (wall_top <= visible_bottom)
+        )
+        hidden = indexes[touching]
+        for index in hidden.tolist():
+            self.walls[index].hide()
+        self._visible[hidden] = False
+
+
 class Scene:
     def __init__(
         self,
@@ -429,19 +579,42 @@ class Scene:
         self._platform_orientations = platform_orientations
         self.walls = []
         self.carved = False
+        self._wall_carver = None
+        self._platform_grid = PlatformGrid(PLATFORM_GRID_CELL)
+        # The entities drawing the walls and platforms, and what was in view when they were made
+        self._thing_entities = []
+        self._things_in_view = None
 
     def set_platforms(self, platforms):
         self._platforms_set = True
         self._platform_expectations = {platform.expected_bounce_frame(): platform for platform in platforms}
         self.platforms = platforms
+        self._platform_grid = PlatformGrid(PLATFORM_GRID_CELL, platforms)
+
+    def platforms_near_ball(self):
+        """The platforms the ball could bounce off this frame, in the same order as self.platforms."""
+        # Platforms only ever get added to the end of the list, so catch the grid up with the new ones
+        for platform in self.platforms[len(self._platform_grid) :]:
+            self._platform_grid.append(platform)
+        ball = self.ball
+        indexes = self._platform_grid.near(
+            ball.x_coord,
+            ball.y_coord,
+            ball.x_coord + ball.width,
+            ball.y_coord + ball.height,
+        )
+        return [self.platforms[index] for index in indexes]
 
     def set_walls(self, walls, carved=False):
         self.carved = carved
 
         if not carved:
             self.walls = walls
+            self._wall_carver = WallCarver(walls) if walls else None
             return
 
+        self._wall_carver = None
+
         rects = [(wall.x_coord, wall.y_coord, wall.width, wall.height) for wall in walls]
         num_rects = len(rects)
         click.echo(f"\nMerging walls ...")
@@ -493,11 +666,12 @@ class Scene:
         )
 
         # Move ball and check for collisions
-        # If the walls are already carved, don't pass them into Move, since we can skip the collision checks
-        if self.carved:
-            hit_platform = self.ball.move(self.platforms, [], self.frame_count, visible_bounds)
-        else:
-            hit_platform = self.ball.move(self.platforms, self.walls, self.frame_count, visible_bounds)
+        # Only the platforms near the ball can be hit, so the rest are skipped before calling Move
+        hit_platform = self.ball.move(self.platforms_near_ball(), self.frame_count, visible_bounds)
+
+        # If the walls are already carved, the ball doesn't need to go through them anymore
+        if self._wall_carver is not None:
+            self.ball.carve(self._wall_carver, visible_bounds, hit_platform)
 
         self.adjust_camera()
 
@@ -512,7 +686,8 @@ class Scene:
         if hit_platform and self.frame_count != hit_platform.expected_bounce_frame():
             raise BadSimulation(f"A platform was hit on the wrong frame {self.frame_count}")
 
-    def render(self) -> Image:
+    def render(self) -> np.ndarray:
+        # Clears everything but the walls, platforms and ball, they stay in the scene from one frame to the next
         scene.clear()
 
         # Determine the visible area based on the current offset
@@ -524,20 +699,46 @@ class Scene:
         )
 
         # Only render walls and platforms if they are within the visible area
-        for wall in self.walls:
-            if wall.in_frame(visible_bounds):
-                wall.render(self.offset_x, self.offset_y)
+        things = [
+            thing
+            for thing in itertools.chain(self.walls, self.platforms)
+            if thing.visible and thing.in_frame(visible_bounds)
+        ]
 
-        for platform in self.platforms:
-            if platform.in_frame(visible_bounds):
-                platform.render(self.offset_x, self.offset_y)
+        # The ones of the same color all go into one mesh, so they are drawn as a single entity.
+        # The meshes are in world coordinates, so they only need building again when what is in view changes
+        things_in_view = [(id(thing), thing.color) for thing in things]
+        if things_in_view != self._things_in_view:
+            self._things_in_view = things_in_view
+            self.destroy_thing_entities()
+            polygons_by_color = {}
+            for thing in things:
+                polygons_by_color.setdefault(thing.color, []).append(thing.polygon(0, 0))
+            for thing_color, polygons in polygons_by_color.items():
+                self._thing_entities.append(CustomWall(polygons, color=hex_to_rgba(thing_color), eternal=True))
+
+        for entity in self._thing_entities:
+            entity.position = (-self.offset_x, -self.offset_y, 0)
+
+        for thing in things:
+            if thing.color_changed:
+                PointLight(
+                    position=(thing.x_coord - self.offset_x, thing.y_coord - self.offset_y, thing.depth - 0.5),
+                    color=color.white,
+                )
 
         if self.ball.in_frame(visible_bounds):
             self.ball.render(self.offset_x, self.offset_y)
 
-        fname = f"{get_cache_dir()}/frame.jpg"
-        base.win.saveScreenshot(fname)
-        return Image.open(fname)
+        # Read the frame straight out of the window, its rows start at the bottom
+        screenshot = base.win.getScreenshot()
+        frame = np.frombuffer(screenshot.getRamImageAs("RGB"), dtype=np.uint8)
+        return frame.reshape(screenshot.getYSize(), screenshot.getXSize(), 3)[::-1]
+
+    def destroy_thing_entities(self):
+        for entity in self._thing_entities:
+            destroy(entity)
+        self._thing_entities = []
 
     def adjust_camera(self):
         edge_x = self.screen_width * 0.5
@@ -569,14 +770,16 @@ class Scene:
 
     @staticmethod
     def create_squares(list_of_x_coords, list_of_y_coords):
-        list_of_x_coords = sorted(list_of_x_coords)
-        list_of_y_coords = sorted(list_of_y_coords)
-        return [
-            [x, y, x2 - x, y2 - y]
-            for x, x2 in zip(list_of_x_coords[:-1], list_of_x_coords[1:])
-            for y, y2 in zip(list_of_y_coords[:-1], list_of_y_coords[1:])
-            if x2 - x and y2 - y
-        ]
+        """Every cell of the grid the coordinates make, as [x, y, width, height] rows going down each column."""
+        # Cells with no width or height get skipped, that's the same as only keeping the distinct coordinates
+        xs = np.unique(list_of_x_coords)
+        ys = np.unique(list_of_y_coords)
+        squares = np.empty((len(xs) - 1, len(ys) - 1, 4), dtype=xs.dtype)
+        squares[..., 0] = xs[:-1, None]
+        squares[..., 1] = ys[None, :-1]
+        squares[..., 2] = np.diff(xs)[:, None]
+        squares[..., 3] = np.diff(ys)[None, :]
+        return squares.reshape(-1, 4)
 
     def place_walls(self):
         list_of_x_coords = []
@@ -586,14 +789,14 @@ class Scene:
             list_of_y_coords += [platform.y_coord, platform.y_coord + platform.height]
 
         walls = self.create_squares(list_of_x_coords, list_of_y_coords)
-        for x, y, W, H in walls:
+        for x, y, W, H in walls.tolist():
             self.walls.append(Wall(x, y, W, H, WALL_COLOR))
 
         # Find the minimum and maximum extents of existing walls
-        minX = min(w[0] for w in walls)
-        maxX = max(w[0] + w[2] for w in walls)
-        minY = min(w[1] for w in walls)
-        maxY = max(w[1] + w[3] for w in walls)
+        minX = walls[:, 0].min().item()
+        maxX = (walls[:, 0] + walls[:, 2]).max().item()
+        minY = walls[:, 1].min().item()
+        maxY = (walls[:, 1] + walls[:, 3]).max().item()
 
         WS = SCREEN_WIDTH * 2
         HS = SCREEN_HEIGHT * 2
@@ -660,21 +863,34 @@ class Scene:
         sustain_pedal=False,
     ):
         video_file = f"{get_cache_dir()}/{filename}.mp4"
-        writer = imageio.get_writer(video_file, fps=FPS)
+        # Without a video, nothing gets rendered, so there's no writer to start up
+        frame_writer = contextlib.nullcontext()
+        if save_video:
+            # The music only depends on the midi, so it's rendered while the frames are
+            music = start_music(midi, SOUND_FONT_FILE_BETTER, new_instrument, isolated_tracks, sustain_pedal)
+            writer = get_video_writer(video_file, FPS)
+            # Ursina has to render on this thread, so only the encoding is handed off, to the writer's thread.
+            # The frames are copied out of the window right away, before the next frame overwrites it
+            frame_writer = ParallelFrameWriter(writer, copy_frame, workers=1)
         try:
-            for _ in range(num_frames):
-                self.update(change_colors)
-                if save_video:
-                    app.step()
-                    writer.append_data(np.array(self.render()))
-                progress = (self.frame_count / num_frames) * 100
-                click.echo(f"\r{progress:0.0f}% ({self.frame_count} frames)", nl=False)
+            with frame_writer:
+                for _ in range(num_frames):
+                    self.update(change_colors)
+                    if save_video:
+                        app.step()
+                        frame_writer.append(self.render())
+                    progress = (self.frame_count / num_frames) * 100
+                    click.echo(f"\r{progress:0.0f}% ({self.frame_count} frames)", nl=False)
         except KeyboardInterrupt:
             if not save_video:
                 cleanup_cache_dir()
                 exit()
             click.echo("\nSave video so far...")
 
+        # The walls, platforms and ball outlive scene.clear(), so take them out before another scene renders
+        self.destroy_thing_entities()
+        self.ball.destroy_entities()
+
         if save_video:
             click.echo(f"\nGenerating the {filename} video...")
             finalize_video_with_music(
@@ -689,76 +905,209 @@ class Scene:
                 new_instrument,
                 isolated_tracks,
                 sustain_pedal,
+                music=music,
             )
 
 
-def choices_are_valid(note_frames, boolean_choice_list):
-    choices = {}
-    frame_list = sorted(list(note_frames))
-    for idx, choice in enumerate(boolean_choice_list):
-        choices[frame_list[idx]] = choice
-    num_frames = max(choices.keys())
+def copy_platforms(platforms):
+    copies = []
+    for platform in platforms:
+        copy = Platform(
+            platform.x_coord,
+            platform.y_coord,
+            platform.width,
+            platform.height,
+            platform.color,
+            platform.orientation,
+            platform.index,
+        )
+        copy.set_expected_bounce_frame(platform.expected_bounce_frame())
+        copies.append(copy)
+    return copies
+
+
+def place_platforms(note_frames, boolean_choice_list, placed=None):
+    """
+    Run Choices through empty Environment to place the Platforms.
 
-    # First - Run Choices through empty Environment to place the Platforms
+    `placed` is what this returned for the same choices minus the last one, so only the frames since
+    then get simulated, instead of every choice from the start.
+    """
+    frame = sorted(note_frames)[len(boolean_choice_list) - 1]
     ball = Ball(BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED)
-    scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames, choices)
-    for _ in range(num_frames):
+    scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames, {frame: boolean_choice_list[-1]})
+    if placed is not None:
+        ball_state, scene.frame_count, scene.offset_x, scene.offset_y, platforms = placed
+        ball.x_coord, ball.y_coord, ball.x_speed, ball.y_speed = ball_state
+        # Copied, since the saved platforms are shared with the other choices after them
+        scene.platforms = copy_platforms(platforms)
+
+    while scene.frame_count < frame:
         scene.update()
 
-    # Then - Check if Scene is valid when platforms placed at start
-    ball = Ball(BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED)
-    platforms = scene.platforms
-    scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball)
-    scene.set_platforms(platforms)
-    try:
-        for _ in range(num_frames):
-            scene.update()
-    except BadSimulation:
-        return False
-
-    return True
-
-
-def get_valid_platform_choices(note_frames: set, boolean_choice_list: list = []):
-    if not boolean_choice_list:
-        boolean_choice_list.append(random.choice([True, False]))
-
-    progress_string = "".join(["─" if i else "|" for i in boolean_choice_list])
-    prog_length = 60
-    expected = len(note_frames)
-    actual = len(boolean_choice_list)
-    progress = int((actual / expected) * 100)
-    trunc = f"({len(progress_string)-prog_length}):" if len(progress_string) >= prog_length else ""
-    click.echo(f"\rProgress: {progress}%\t{trunc}{progress_string[-(prog_length-len(trunc)):]}", nl=False)
-    if len(boolean_choice_list) == len(note_frames):
-        if choices_are_valid(note_frames, boolean_choice_list):
-            return boolean_choice_list
-        else:
-            return None
+    ball_state = (ball.x_coord, ball.y_coord, ball.x_speed, ball.y_speed)
+    return ball_state, scene.frame_count, scene.offset_x, scene.offset_y, scene.platforms
+
+
+@njit(cache=True)
+def run_bounces(boxes, orientations, expected, ball, first_frame, num_frames):
+    """
+    The same physics as Scene.update (with Ball.move and adjust_camera), for the platforms as (x, y, width, height)
+    rows. Carries on from `ball` - (x, y, x speed, y speed, camera offset x, camera offset y) after the frame before
+    `first_frame` - through `num_frames`. The ball has to hit each platform on its expected frame (0 when that is
+    not known yet) and no platform on any other frame.
+
+    Returns whether it did, the ball after the last frame, the ball positions the platforms were checked against
+    on each frame, and whether a platform with no expected frame got hit.
+    """
+    expected = expected.copy()
+    bounce_frames = set()
+    for frame in expected:
+        if frame:
+            bounce_frames.add(frame)
+
+    x, y, x_speed, y_speed, offset_x, offset_y = ball
+    xs = np.empty(max(num_frames - first_frame + 1, 0))
+    ys = np.empty(max(num_frames - first_frame + 1, 0))
+    unknown_hit = False
+    for frame in range(first_frame, num_frames + 1):
+        xs[frame - first_frame] = x
+        ys[frame - first_frame] = y
+        visible_left = offset_x - (3 * SCREEN_WIDTH)
+        visible_right = offset_x + (3 * SCREEN_WIDTH)
+        visible_top = offset_y - (3 * SCREEN_HEIGHT)
+        visible_bottom = offset_y + (3 * SCREEN_HEIGHT)
+
+        hit = -1
+        for index in range(len(boxes)):
+            plat_left = boxes[index, 0]
+            plat_right = boxes[index, 0] + boxes[index, 2]
+            plat_top = boxes[index, 1]
+            plat_bottom = boxes[index, 1] + boxes[index, 3]
+            if (
+                plat_right < visible_left
+                or plat_left > visible_right
+                or plat_bottom < visible_top
+                or plat_top > visible_bottom
+            ):
+                continue
 
-    # Check if the current partial string is valid
-    if not choices_are_valid(note_frames, boolean_choice_list):
-        # Prune the search tree here
-        return None
+            ball_right = x + BALL_SIZE
+            ball_bottom = y + BALL_SIZE
+            if ball_right >= plat_left and x <= plat_right and ball_bottom >= plat_top and y <= plat_bottom:
+                overlap_left = ball_right - plat_left
+                overlap_right = plat_right - x
+                overlap_top = ball_bottom - plat_top
+                overlap_bottom = plat_bottom - y
+                min_overlap = min(overlap_left, overlap_right, overlap_top, overlap_bottom)
+                if orientations[index]:
+                    if min_overlap == overlap_top or min_overlap == overlap_bottom:
+                        y_speed = -y_speed
+                else:
+                    if min_overlap == overlap_left or min_overlap == overlap_right:
+                        x_speed = -x_speed
+                if not expected[index]:
+                    expected[index] = frame
+                    unknown_hit = True
+                hit = index
+                break
 
-    # STRATEGY - CYCLE
-    # if boolean_choice_list[-1]:
-    #     next_choices = [False, True]
-    # else:
-    #     next_choices = [True, False]
-
-    # STRATEGY - RANDOM
-    next_choices = [True, False]
-    if random.choice([True, False]):
-        next_choices = next_choices[::-1]
-
-    for rand_choice in next_choices:
-        result = get_valid_platform_choices(
-            note_frames,
-            boolean_choice_list + [rand_choice],
-        )
-        if result is not None:
-            return result
+        x += x_speed
+        y += y_speed
+
+        edge_x = SCREEN_WIDTH * 0.5
+        edge_y = SCREEN_HEIGHT * 0.5
+        desired_offset_x = x - edge_x if x_speed < 0 else x - (SCREEN_WIDTH - edge_x)
+        desired_offset_y = y - edge_y if y_speed < 0 else y - (SCREEN_HEIGHT - edge_y)
+        offset_x = offset_x + (desired_offset_x - offset_x) * ALPHA
+        offset_y = offset_y + (desired_offset_y - offset_y) * ALPHA
+
+        valid = not (hit == -1 and frame in bounce_frames) and not (hit != -1 and frame != expected[hit])
+        if not valid:
+            return False, (x, y, x_speed, y_speed, offset_x, offset_y), xs, ys, unknown_hit
+
+    return True, (x, y, x_speed, y_speed, offset_x, offset_y), xs, ys, unknown_hit
+
+
+def check_choices(placed, checked=None):
+    """
+    Check the ball bounces off the placed platforms on the right frames, returns None when it does not.
+
+    `checked` is what this returned for the same choices minus the last one. Carrying on from there gives the
+    same result as checking from the first frame, as long as the new platform is nowhere the ball has already
+    been, and no platform got hit before its bounce frame was known.
+    """
+    num_frames = placed[1]
+    platforms = placed[4]
+    boxes = np.array(
+        [(platform.x_coord, platform.y_coord, platform.width, platform.height) for platform in platforms],
+        dtype=float,
+    ).reshape(-1, 4)
+    orientations = np.array([bool(platform.orientation) for platform in platforms], dtype=bool)
+    expected = np.array([platform.expected_bounce_frame() or 0 for platform in platforms], dtype=np.int64)
+
+    if checked is not None:
+        ball, frame, ball_xs, ball_ys, replay = checked
+        new = platforms[-1]
+        if replay or np.any(
+            (ball_xs + BALL_SIZE >= new.x_coord)
+            & (ball_xs <= new.x_coord + new.width)
+            & (ball_ys + BALL_SIZE >= new.y_coord)
+            & (ball_ys <= new.y_coord + new.height)
+        ):
+            checked = None
+    if checked is None:
+        ball, frame = (float(BALL_START_X), float(BALL_START_Y), BALL_SPEED, BALL_SPEED, 0.0, 0.0), 0
+        ball_xs = ball_ys = np.empty(0)
+
+    valid, ball, xs, ys, unknown_hit = run_bounces(boxes, orientations, expected, ball, frame + 1, num_frames)
+    if not valid:
+        return None
+    return ball, num_frames, np.concatenate([ball_xs, xs]), np.concatenate([ball_ys, ys]), unknown_hit
+
+
+def get_valid_platform_choices(note_frames: set):
+    # Depth first search over the choices, using an explicit stack of the choices still to visit (with their depth),
+    # along with the platforms placed and checked for the choices before the last one
+    boolean_choice_list = []
+    stack = [(0, random.choice([True, False]), None, None)]
+    while stack:
+        depth, choice, parent_placed, parent_checked = stack.pop()
+        # Backtrack the shared choice list to the parent of this entry, and add its choice
+        del boolean_choice_list[depth:]
+        boolean_choice_list.append(choice)
+
+        prog_length = 60
+        progress_string = "".join(["─" if i else "|" for i in boolean_choice_list[-prog_length:]])
+        expected = len(note_frames)
+        actual = len(boolean_choice_list)
+        progress = int((actual / expected) * 100)
+        trunc = f"({actual-prog_length}):" if actual >= prog_length else ""
+        click.echo(f"\rProgress: {progress}%\t{trunc}{progress_string[-(prog_length-len(trunc)):]}", nl=False)
+        placed = place_platforms(note_frames, boolean_choice_list, parent_placed)
+        # Check if the current partial string is valid
+        checked = check_choices(placed, parent_checked)
+        if checked is None:
+            # Prune the search tree here
+            continue
+
+        if len(boolean_choice_list) == len(note_frames):
+            return boolean_choice_list, placed[4]
+
+        # STRATEGY - CYCLE
+        # if boolean_choice_list[-1]:
+        #     next_choices = [False, True]
+        # else:
+        #     next_choices = [True, False]
+
+        # STRATEGY - RANDOM
+        next_choices = [True, False]
+        if random.choice([True, False]):
+            next_choices = next_choices[::-1]
+
+        # Push in reverse, so the first choice is the next one popped
+        for next_choice in reversed(next_choices):
+            stack.append((actual, next_choice, placed, checked))
 
     return None
 
@@ -832,32 +1181,23 @@ def main(midi, max_frames, new_instrument, animate_tracks, isolate, sustain_peda
     # Run the backtracking alg to figure out where to place the platforms
     num_platforms = len(note_frames)
     click.echo(f"Searching for valid placement for {num_platforms} platforms...")
-    boolean_choice_list = get_valid_platform_choices(note_frames)
-    if not boolean_choice_list:
+    search_result = get_valid_platform_choices(note_frames)
+    if not search_result:
         click.echo("\nCould not figure out platforms :(")
         click.echo("\nTry changing ball and platform size, and speed")
         exit(0)
+    boolean_choice_list, platforms = search_result
+    num_frames = max(note_frames)
 
-    # Convert `boolean_choice_list` to `choices`
-    # Choices is DICT, KEY=FRAME NUMBER, VAL=Bool for if the platform hit on this frame is Horizontal or Vertical
-    choices = {}
-    frame_list = sorted(list(note_frames))
-    for idx, choice in enumerate(boolean_choice_list):
-        choices[frame_list[idx]] = choice
-    num_frames = max(choices.keys())
-
-    click.echo(f"\nRunning simulation to place {num_platforms} platforms...")
+    # The search already ran the simulation that places the platforms, so go straight to placing the walls
     ball = Ball(BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED)
-    scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames, choices)
-    scene.run_simulation(midi, f"{song_name}-platforms", num_frames, False, new_instrument, isolated_tracks)
-
-    # After the platforms are placed in the first simulation, place the walls
+    scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames)
+    scene.set_platforms(platforms)
     scene.place_walls()
     walls = scene.walls
 
     # Run the next simulation with the platforms and walls in place, and carve the walls
     click.echo(f"\nRunning the simulation again to carve {len(walls)} walls)...")
-    platforms = scene.platforms
     ball = Ball(BALL_START_X, BALL_START_Y, BALL_SIZE, BALL_COLOR, BALL_SPEED)
     scene = Scene(SCREEN_WIDTH, SCREEN_HEIGHT, ball, note_frames)
     scene.set_platforms(platforms)
@@ -1,19 +1,13 @@
-from PIL import Image
+import time
+from collections import defaultdict
+
 import click
+import imageio
 import pygame
 from src.midi_stuff import get_frames_where_notes_happen_by_track, convert_midi_to_wav
 from src.cache_stuff import get_cache_dir, cleanup_cache_dir
 
 
-def pygame_surface_to_pil_image(surface):
-    """Convert a PyGame surface to a PIL Image."""
-    # First, convert the surface to string buffer with the same pixel layout as the surface
-    string_image = pygame.image.tostring(surface, "RGBA")
-
-    # Create a PIL Image from the string buffer
-    return Image.frombytes("RGBA", surface.get_size(), string_image)
-
-
 @click.command()
 @click.option(
     "--midi",
@@ -21,7 +15,13 @@ def pygame_surface_to_pil_image(surface):
     type=click.Path(exists=True),
     help="Path to a MIDI file.",
 )
-def main(midi):
+@click.option(
+    "--save_video",
+    default=False,
+    is_flag=True,
+    help="Also save what the viewer shows to a video (without the music)",
+)
+def main(midi, save_video):
     frame_rate = 60
     note_starts_in_frames = get_frames_where_notes_happen_by_track(midi, frame_rate)
     pygame.init()
@@ -37,8 +37,38 @@ def main(midi):
     clock = pygame.time.Clock()
     font = pygame.font.Font(None, 36)  # Default font and a size of 36
 
+    # The track names never change, so render each one once in grey and in black, along with where it goes
+    track_labels = {}
+    for x, track in enumerate(note_starts_in_frames, start=1):
+        track_labels[track] = []
+        for text_color in [(200, 200, 200), (0, 0, 0)]:
+            text_surface = font.render(track, True, text_color)
+            position = (
+                WIDTH // 2 - text_surface.get_width() // 2,
+                (text_surface.get_height() // 2) + x * 30,
+            )
+            track_labels[track].append((text_surface, position))
+
+    # Nothing outside the track names ever changes, so only that part gets redrawn and updated each frame
+    label_rects = [
+        pygame.Rect(position, surface.get_size()) for labels in track_labels.values() for surface, position in labels
+    ]
+    text_rect = label_rects[0].unionall(label_rects) if label_rects else pygame.Rect(0, 0, 0, 0)
+    screen.fill((255, 255, 255))  # White background
+    pygame.display.flip()
+
+    writer = None
+    if save_video:
+        song_name = midi.split("/")[-1].split(".mid")[0]
+        writer = imageio.get_writer(f"{song_name}-tracks_{int(time.time())}.mp4", fps=frame_rate)
+
+    # The whole schedule is known up front, so look up which tracks start a note on each frame once
+    tracks_starting = defaultdict(list)
+    for track, frames in note_starts_in_frames.items():
+        for frame in frames:
+            tracks_starting[frame].append(track)
+
     curr_frame = 0
-    frame_grabs = []
     running = True
     track_display_counters = {track: 0 for track in note_starts_in_frames}
     sound.play()
@@ -49,47 +79,34 @@ def main(midi):
             if event.type == pygame.QUIT:
                 running = False
 
-        screen.fill((255, 255, 255))  # White background
+        screen.fill((255, 255, 255), text_rect)  # White background behind the track names
 
-        # Check each track to see if a note is starting on this frame
-        for track, frames in note_starts_in_frames.items():
-            if frames.get(curr_frame, False):
-                track_display_counters[track] = 1
+        # Light up the tracks with a note starting on this frame
+        for track in tracks_starting.get(curr_frame, ()):
+            track_display_counters[track] = 1
 
-        # Display track names if required
-        x = 0
+        # Display track names if required, all blitted in one go
+        blit_sequence = []
         for track, counter in track_display_counters.items():
-            x += 1
-            text_surface = font.render(track, True, (200, 200, 200))
-            screen.blit(
-                text_surface,
-                (
-                    WIDTH // 2 - text_surface.get_width() // 2,
-                    (text_surface.get_height() // 2) + x * 30,
-                ),
-            )
+            grey_label, black_label = track_labels[track]
+            blit_sequence.append(grey_label)
             if counter > 0:
-                text_surface = font.render(track, True, (0, 0, 0))
-                screen.blit(
-                    text_surface,
-                    (
-                        WIDTH // 2 - text_surface.get_width() // 2,
-                        (text_surface.get_height() // 2) + x * 30,
-                    ),
-                )
+                blit_sequence.append(black_label)
                 track_display_counters[track] -= 1  # Decrement the counter
+        screen.blits(blit_sequence, doreturn=False)
 
-        pygame.display.flip()  # Update the display
+        pygame.display.update(text_rect)  # Update the part of the display with the track names
 
-        # Save screen
-        frame_surface = pygame.Surface(screen.get_size())
-        frame_surface.blit(screen, (0, 0))
-        frame_grabs.append(pygame_surface_to_pil_image(frame_surface))
+        # Stream the frame to ffmpeg as soon as it's drawn, instead of holding on to every frame
+        if writer is not None:
+            writer.append_data(pygame.surfarray.array3d(screen).swapaxes(0, 1))
 
         curr_frame += 1
 
         clock.tick(frame_rate)
 
+    if writer is not None:
+        writer.close()
     pygame.quit()
     cleanup_cache_dir()
 
@@ -1,6 +1,10 @@
+from functools import lru_cache
+
 from ursina.color import rgb32
 
 
+# Only a handful of colors are ever used, so each one is parsed once
+@lru_cache(maxsize=None)
 def hex_to_rgba(hex_color):
     # Remove the '#' character if it's present
     hex_color = hex_color.lstrip("#")
@@ -0,0 +1,173 @@
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+
+@lru_cache(maxsize=None)
+def get_ink(color, mode):
+    # Hex strings go through PIL, so colors match what ImageDraw would have used
+    if isinstance(color, str):
+        return ImageColor.getcolor(color, mode)
+    # RGB tuples drawn on an RGBA frame are fully opaque
+    if len(color) < len(mode):
+        return (*color, 255)
+    return color
+
+
+def fill_box(canvas, x0, y0, x1, y1, ink):
+    """Fill the box from (x0, y0) to (x1, y1) inclusive, clipped to the canvas."""
+    x0 = max(x0, 0)
+    y0 = max(y0, 0)
+    x1 = min(x1, canvas.shape[1] - 1)
+    y1 = min(y1, canvas.shape[0] - 1)
+    if x0 <= x1 and y0 <= y1:
+        canvas[y0 : y1 + 1, x0 : x1 + 1] = ink
+
+
+def draw_rectangle(canvas, mode, xy, fill=None, outline=None, width=1):
+    """
+    Draw a rectangle straight into a numpy frame.
+
+    Gives the same pixels as ImageDraw.rectangle - the coordinates are truncated to ints,
+    and both corners are included. Like ImageDraw, `xy` is either [x0, y0, x1, y1] or [(x0, y0), (x1, y1)].
+    """
+    if len(xy) == 2:
+        (x0, y0), (x1, y1) = xy
+    else:
+        x0, y0, x1, y1 = xy
+    x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+    fill = get_ink(fill, mode) if fill is not None else None
+    outline = get_ink(outline, mode) if outline is not None else None
+
+    if fill is not None:
+        fill_box(canvas, x0, y0, x1, y1, fill)
+
+    if outline is None or outline == fill or width == 0:
+        return
+
+    # Top and bottom edges
+    fill_box(canvas, x0, y0, x1, y0 + width - 1, outline)
+    fill_box(canvas, x0, y1 - width + 1, x1, y1, outline)
+
+    # Left and right edges, PIL draws these as lines that stop one pixel short of their end point
+    side_start, side_end = y0 + width, y1 - width + 1
+    if side_end >= side_start:
+        side_top, side_bottom = side_start, side_end - 1
+    else:
+        side_top, side_bottom = side_end + 1, side_start
+    fill_box(canvas, x0, side_top, x0 + width - 1, side_bottom, outline)
+    fill_box(canvas, x1 - width + 1, side_top, x1, side_bottom, outline)
+
+
+@lru_cache(maxsize=None)
+def get_ellipse_mask(width, height):
+    """The pixels of a filled ellipse with its corners at (0, 0) and (width, height)."""
+    mask = Image.new("1", (width + 1, height + 1), 0)
+    ImageDraw.Draw(mask).ellipse([(0, 0), (width, height)], fill=1)
+    return np.array(mask, dtype=bool)
+
+
+def draw_ellipse(canvas, mode, xy, fill=None, outline=None, width=1):
+    """Draw an ellipse into a numpy frame, with the same pixels as ImageDraw.ellipse."""
+    (x0, y0), (x1, y1) = xy
+    if outline is None:
+        if fill is None:
+            return
+        # PIL truncates the corners to ints before drawing, so the filled shape only depends on the size
+        # of the box, and a cached mask of it can be stamped at the top left corner
+        left, top = int(x0), int(y0)
+        mask = get_ellipse_mask(int(x1) - left, int(y1) - top)
+        mask_x0, mask_y0 = max(-left, 0), max(-top, 0)
+        mask_x1 = min(mask.shape[1], canvas.shape[1] - left)
+        mask_y1 = min(mask.shape[0], canvas.shape[0] - top)
+        if mask_x0 < mask_x1 and mask_y0 < mask_y1:
+            region = canvas[top + mask_y0 : top + mask_y1, left + mask_x0 : left + mask_x1]
+            region[mask[mask_y0:mask_y1, mask_x0:mask_x1]] = get_ink(fill, mode)
+        return
+
+    # With an outline, let PIL draw it on a small tile of the frame.
+    # Only shift the ellipse by whole pixels when its corner is on the canvas,
+    # so PIL rounds its coordinates exactly the same way as on the full frame
+    tile_x0 = max(int(x0) - 1, 0)
+    tile_y0 = max(int(y0) - 1, 0)
+    tile_x1 = min(int(x1) + 2, canvas.shape[1])
+    tile_y1 = min(int(y1) + 2, canvas.shape[0])
+    if tile_x0 >= tile_x1 or tile_y0 >= tile_y1:
+        return
+
+    tile = Image.fromarray(canvas[tile_y0:tile_y1, tile_x0:tile_x1], mode)
+    ImageDraw.Draw(tile).ellipse(
+        [(x0 - tile_x0, y0 - tile_y0), (x1 - tile_x0, y1 - tile_y0)],
+        fill=fill,
+        outline=outline,
+        width=width,
+    )
+    canvas[tile_y0:tile_y1, tile_x0:tile_x1] = tile
+
+
+class RectangleLayer:
+    """
+    Rectangles that never change, drawn once into tiles that get copied into each frame.
+
+    `rectangles` are (x0, y0, x1, y1) in whole pixels, with both corners included like ImageDraw.
+    A frame painted at (left, top) shows the layer's pixel (left + x, top + y) at its own (x, y).
+    """
+
+    def __init__(self, rectangles, color, background, mode="RGB", tile_size=512, max_tiles=64):
+        self.rectangles = np.asarray(rectangles, dtype=np.int64).reshape(-1, 4)
+        self.ink = get_ink(color, mode)
+        self.background = get_ink(background, mode)
+        self.mode = mode
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+        self._last_key = None
+        self._last_frame = None
+
+    def _get_tile(self, tile_x, tile_y):
+        tile = self._tiles.get((tile_x, tile_y))
+        if tile is not None:
+            self._tiles.move_to_end((tile_x, tile_y))
+            return tile
+
+        size = self.tile_size
+        left, top = tile_x * size, tile_y * size
+        tile = np.empty((size, size, len(self.mode)), dtype=np.uint8)
+        tile[:] = self.background
+        x0, y0, x1, y1 = self.rectangles.T
+        in_tile = (x1 >= left) & (x0 < left + size) & (y1 >= top) & (y0 < top + size)
+        for rx0, ry0, rx1, ry1 in self.rectangles[in_tile].tolist():
+            fill_box(tile, rx0 - left, ry0 - top, rx1 - left, ry1 - top, self.ink)
+
+        self._tiles[(tile_x, tile_y)] = tile
+        if len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def paint(self, canvas, left, top):
+        """Fill the whole canvas with the part of the layer starting at (left, top)."""
+        height, width = canvas.shape[:2]
+        key = (left, top, width, height)
+        # The same frame over and over again (zoomed out, or the camera at rest) is a single copy
+        if key == self._last_key and self._last_frame is not None:
+            canvas[:] = self._last_frame
+            return
+
+        size = self.tile_size
+        for tile_y in range(top // size, (top + height - 1) // size + 1):
+            for tile_x in range(left // size, (left + width - 1) // size + 1):
+                tile = self._get_tile(tile_x, tile_y)
+                x0, x1 = max(left, tile_x * size), min(left + width, (tile_x + 1) * size)
+                y0, y1 = max(top, tile_y * size), min(top + height, (tile_y + 1) * size)
+                canvas[y0 - top : y1 - top, x0 - left : x1 - left] = tile[
+                    y0 - tile_y * size : y1 - tile_y * size,
+                    x0 - tile_x * size : x1 - tile_x * size,
+                ]
+
+        if key == self._last_key:
+            self._last_frame = canvas.copy()
+        else:
+            self._last_key = key
+            self._last_frame = None
@@ -1,12 +1,30 @@
+import copy
+import os
+from collections import defaultdict
+from functools import lru_cache
+
+import numpy as np
 import pretty_midi
 from midi2audio import FluidSynth
-from collections import defaultdict
 
 SOUND_FONT_FILE_BETTER = "assets/soundfont.sf2"
 
 TRACK_NOTE_DELIMITER = "#"
 
 
+@lru_cache(maxsize=8)
+def _load_midi(midi_file_path, modified_time):
+    return pretty_midi.PrettyMIDI(midi_file_path)
+
+
+def load_midi(midi_file_path):
+    """
+    The parsed MIDI file, shared by every caller so the file only gets parsed once (until it changes).
+    Copy it before changing anything in it.
+    """
+    return _load_midi(os.path.abspath(midi_file_path), os.path.getmtime(midi_file_path))
+
+
 def convert_midi_to_wav(
     midi_file_path,
     wav_file_path,
@@ -24,8 +42,8 @@ def change_instrument(
     isolated_tracks=None,
     sustain_pedal=False,
 ):
-    # Load MIDI file
-    midi_data = pretty_midi.PrettyMIDI(midi_file_path)
+    # Load MIDI file, it gets changed below, so on a copy of the shared one
+    midi_data = copy.deepcopy(load_midi(midi_file_path))
 
     # MIDI volume can range from 0 (silent) to 127 (maximum)
     volume_level = max(0, min(new_volume, 127))
@@ -63,22 +81,25 @@ def change_instrument(
 
 def get_frames_where_notes_happen(midi_file_path, fps, frame_buffer=0, animate_tracks=[]):
     # Load the MIDI file
-    midi_data = pretty_midi.PrettyMIDI(midi_file_path)
+    midi_data = load_midi(midi_file_path)
     frames = set()
     for i, instrument in enumerate(midi_data.instruments, start=1):
         if animate_tracks and i not in animate_tracks:
             continue
-        for note in instrument.notes:
-            frames.add(int(note.start * fps) + frame_buffer)
+        # Work out the frames of all the track's notes at once
+        onsets = instrument.get_onsets()
+        frames.update(((onsets * fps).astype(np.int64) + frame_buffer).tolist())
     return frames
 
 
 def get_frames_where_notes_happen_by_track(midi_file_path, fps):
-    midi_data = pretty_midi.PrettyMIDI(midi_file_path)
-    track_events_frames = defaultdict(lambda: defaultdict(bool))
+    midi_data = load_midi(midi_file_path)
+    # The frames are only ever checked for being there, so each track gets a set of them
+    track_events_frames = defaultdict(set)
     for i, instrument in enumerate(midi_data.instruments):
-        for note in instrument.notes:
-            frame = int(note.start * fps)
-            track_events_frames[f"track_{i+1}"][frame] = True
+        onsets = instrument.get_onsets()
+        frames = (onsets * fps).astype(np.int64).tolist()
+        if frames:
+            track_events_frames[f"track_{i+1}"].update(frames)
 
     return track_events_frames
@@ -0,0 +1,82 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def hide_boxes_touching(boxes, visible, candidates, visible_bounds, box):
+    """
+    Hide the visible boxes, out of `candidates`, that are within the visible bounds and touch `box`.
+
+    `boxes` are (x0, y0, x1, y1) rows and `visible` is updated in place.
+    Returns the indexes of the boxes that just got hidden.
+    """
+    visible_left, visible_right, visible_top, visible_bottom = visible_bounds
+    left, top, right, bottom = box
+    hidden = np.empty(len(candidates), dtype=np.int64)
+    count = 0
+    for index in candidates:
+        if not visible[index]:
+            continue
+        x0, y0, x1, y1 = boxes[index, 0], boxes[index, 1], boxes[index, 2], boxes[index, 3]
+        if x1 < visible_left or x0 > visible_right or y1 < visible_top or y0 > visible_bottom:
+            continue
+        if right >= x0 and left <= x1 and bottom >= y0 and top <= y1:
+            visible[index] = False
+            hidden[count] = index
+            count += 1
+    return hidden[:count]
+
+
+class PlatformGrid:
+    """
+    Buckets the platforms into a uniform grid of cells, so only the platforms near the ball get checked.
+
+    Platforms only need `x_coord`, `y_coord`, `width` and `height`, and should fit in a cell.
+    """
+
+    def __init__(self, cell_size, platforms=()):
+        self.cell_size = cell_size
+        self._cells = {}  # cell -> indexes of the platforms touching it, in order
+        self._platform_cells = []  # platform index -> the cells it touches
+        for platform in platforms:
+            self.append(platform)
+
+    def _cells_covering(self, left, top, right, bottom):
+        size = self.cell_size
+        return [
+            (cell_x, cell_y)
+            for cell_x in range(int(left // size), int(right // size) + 1)
+            for cell_y in range(int(top // size), int(bottom // size) + 1)
+        ]
+
+    def append(self, platform):
+        index = len(self._platform_cells)
+        cells = self._cells_covering(
+            platform.x_coord,
+            platform.y_coord,
+            platform.x_coord + platform.width,
+            platform.y_coord + platform.height,
+        )
+        for cell in cells:
+            self._cells.setdefault(cell, []).append(index)
+        self._platform_cells.append(cells)
+
+    def truncate(self, count):
+        # The removed platforms have the highest indexes, so they are at the end of each of their cells
+        for cells in reversed(self._platform_cells[count:]):
+            for cell in cells:
+                self._cells[cell].pop()
+        del self._platform_cells[count:]
+
+    def __len__(self):
+        return len(self._platform_cells)
+
+    def near(self, left, top, right, bottom):
+        """Indexes (in order) of the platforms sharing a cell with the box."""
+        cells = self._cells_covering(left, top, right, bottom)
+        if len(cells) == 1:
+            return self._cells.get(cells[0], [])
+        indexes = set()
+        for cell in cells:
+            indexes.update(self._cells.get(cell, []))
+        return sorted(indexes)
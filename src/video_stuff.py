@@ -1,8 +1,15 @@
 import os
 import time
 import subprocess
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import click
+import imageio
+import numpy as np
 from moviepy.editor import VideoFileClip, AudioFileClip
 from pydub import AudioSegment
 
@@ -10,26 +17,131 @@ from src.midi_stuff import convert_midi_to_wav, change_instrument
 from src.cache_stuff import get_cache_dir
 
 
-def finalize_video_with_music(
-    writer,
-    video_file_path,
-    output_file_name,
+class ParallelFrameWriter:
+    """
+    Renders frames on a pool of worker processes, and appends them to the video writer in order.
+
+    `render_fn` must be a module level function (so it can be pickled) that turns whatever is passed
+    to `append` into a frame the writer accepts. With a single worker, frames are rendered inline.
+    `initializer(*initargs)` is run once in every process that renders frames, to hand it any data
+    that is the same for every frame.
+
+    The rendered frames are handed to the writer on a separate thread, so rendering the next frames
+    carries on while ffmpeg is busy encoding.
+    """
+
+    # Rendered frames waiting for the writer thread
+    max_queued_frames = 8
+
+    def __init__(self, writer, render_fn, workers=None, initializer=None, initargs=()):
+        self.writer = writer
+        self.render_fn = render_fn
+        self.workers = workers or os.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self._pool = None
+        self._pending = deque()
+        self._rendered = queue.Queue(maxsize=self.max_queued_frames)
+        self._writer_thread = None
+        self._writer_error = None
+
+    def __enter__(self):
+        if self.workers > 1:
+            self._pool = multiprocessing.Pool(self.workers, self.initializer, self.initargs)
+        elif self.initializer is not None:
+            self.initializer(*self.initargs)
+        self._writer_thread = threading.Thread(target=self._write_frames)
+        self._writer_thread.start()
+        return self
+
+    def _write_frames(self):
+        while True:
+            frame = self._rendered.get()
+            if frame is None:
+                return
+            # After an error, keep emptying the queue so append never blocks on it
+            if self._writer_error is not None:
+                continue
+            try:
+                self.writer.append_data(frame)
+            except Exception as e:
+                self._writer_error = e
+
+    def _write(self, frame):
+        if self._writer_error is not None:
+            raise self._writer_error
+        self._rendered.put(frame)
+
+    def append(self, frame):
+        if self._pool is None:
+            self._write(self.render_fn(frame))
+            return
+
+        self._pending.append(self._pool.apply_async(self.render_fn, (frame,)))
+        # Keep every worker busy, without letting the queue of rendered frames grow unbounded
+        if len(self._pending) > self.workers * 2:
+            self._write(self._pending.popleft().get())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                while self._pending:
+                    self._write(self._pending.popleft().get())
+        finally:
+            if self._pool is not None:
+                if exc_type is None:
+                    self._pool.close()
+                else:
+                    self._pool.terminate()
+                self._pool.join()
+            self._rendered.put(None)
+            self._writer_thread.join()
+
+        if exc_type is None and self._writer_error is not None:
+            raise self._writer_error
+
+
+# Every process reuses a few buffers per frame size instead of allocating a new frame each time.
+# The writer thread holds at most its queue plus the frame it's writing, so by the time a buffer
+# comes around again, the frame in it has been written out (or sent back from the worker)
+FRAME_BUFFERS_PER_SIZE = ParallelFrameWriter.max_queued_frames + 2
+frame_buffers = {}
+
+
+def get_frame_buffer(shape):
+    buffers = frame_buffers.setdefault(shape, deque(maxlen=FRAME_BUFFERS_PER_SIZE))
+    if len(buffers) < FRAME_BUFFERS_PER_SIZE:
+        buffers.append(np.empty(shape, dtype=np.uint8))
+    else:
+        buffers.rotate(-1)
+    return buffers[-1]
+
+
+def copy_frame(frame):
+    """Copy the frame into one of the reused buffers, for the writer to have while the next frame gets drawn."""
+    buffer = get_frame_buffer(frame.shape)
+    np.copyto(buffer, frame)
+    return buffer
+
+
+def get_video_writer(video_file, fps):
+    """
+    The writer for the video before the music gets added. That video gets encoded again with the music,
+    so it's encoded as fast as possible, which keeps up with the frames much better than the default.
+    """
+    return imageio.get_writer(video_file, fps=fps, ffmpeg_params=["-preset", "ultrafast"])
+
+
+def render_music(
     midi_file_path,
-    frame_rate,
     soundfont_file,
-    frames_written,
-    frame_offset,
     new_instrument=None,
     isolated_tracks=None,
     sustain_pedal=None,
 ):
-    # Ensure the writer is closed
-    writer.close()
-
-    # Audio processing
+    """Render the midi (with the instrument changed, if asked) to a wave file in the cache dir, returns its path."""
     temp_music_file = os.path.join(get_cache_dir(), "temp_music.wav")
     open(temp_music_file, "ab").close()
-    click.echo("Converting midi to wave...")
 
     if new_instrument:
         new_mid_path = f"{get_cache_dir()}/alter.mid"
@@ -47,14 +159,63 @@ def finalize_video_with_music(
         temp_music_file,
         soundfont_file,
     )
+    return temp_music_file
+
+
+def start_music(
+    midi_file_path,
+    soundfont_file,
+    new_instrument=None,
+    isolated_tracks=None,
+    sustain_pedal=None,
+):
+    """
+    Start render_music on a background thread, returns a future for the wave file's path.
+
+    FluidSynth runs as its own process, so started before the frames, the music gets rendered while
+    the video is being made, instead of after it.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    music = executor.submit(
+        render_music, midi_file_path, soundfont_file, new_instrument, isolated_tracks, sustain_pedal
+    )
+    executor.shutdown(wait=False)
+    return music
+
+
+def finalize_video_with_music(
+    writer,
+    video_file_path,
+    output_file_name,
+    midi_file_path,
+    frame_rate,
+    soundfont_file,
+    frames_written,
+    frame_offset,
+    new_instrument=None,
+    isolated_tracks=None,
+    sustain_pedal=None,
+    music=None,
+):
+    """`music` is the future from start_music, if the music was started already."""
+    # Ensure the writer is closed
+    writer.close()
+
+    # Audio processing
+    click.echo("Converting midi to wave...")
+    if music is None:
+        temp_music_file = render_music(midi_file_path, soundfont_file, new_instrument, isolated_tracks, sustain_pedal)
+    else:
+        temp_music_file = music.result()
+
     silent_segment = AudioSegment.silent(duration=frame_offset * 1000 / frame_rate)
     audio_duration = int((frames_written / frame_rate) * 1000)
 
     audio_clip = AudioSegment.from_file(temp_music_file)
     audio_clip = audio_clip[:audio_duration]  # Truncate the audio
 
+    # Only the delayed music gets written out, the truncated clip is just a step on the way there
     temp_audio = f"{get_cache_dir()}/music.wav"
-    audio_clip.export(temp_audio, format="wav")
     delayed_audio_clip = silent_segment + audio_clip
     delayed_audio_clip.export(temp_audio, format="wav")
 